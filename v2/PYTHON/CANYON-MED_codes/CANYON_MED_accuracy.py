@@ -0,0 +1,80 @@
+import sys
+
+import numpy as np
+
+from CANYON_MED_models import CHECK_INPUT, CHECK_VALUES, VARIABLES, get_model
+from CANYON_MED_predict import ensemble_outputs, predict_all, prepare_inputs
+
+# Accuracy of the reduced-precision CANYON-MED computations
+#
+# Compares the predictions computed with a given dtype to the float64
+# ones, on the check values of the CANYON_MED_*_v4 functions and on a
+# large synthetic set of Mediterranean inputs.
+#
+# The members themselves agree closely; the larger deviations of the
+# final estimate come from the rare rows where a member lies right at the
+# +/- 1 std rejection limit and is kept in one precision but not in the
+# other, which moves the mean by a fraction of the ensemble spread.
+#
+# usage:
+#   python CANYON_MED_accuracy.py [n_rows]
+
+
+def synthetic_inputs(n, seed=0):
+    # n random but plausible Mediterranean observations
+    # (date, lat, lon, pres, temp, psal, doxy), reproducible for a given seed
+    rng = np.random.default_rng(seed)
+    date = np.datetime64('1990-01-01T00:00:00') + rng.integers(0, 35 * 365 * 86400, n).astype('timedelta64[s]')
+    lat = rng.uniform(30.5, 45.5, n)
+    lon = rng.uniform(-5.5, 36, n)
+    # denser sampling near the surface, as in profiles
+    pres = 4000 * rng.uniform(0, 1, n) ** 2
+    deep = np.exp(-pres / 300)
+    temp = 13 + 12 * deep * rng.uniform(0, 1, n) + rng.normal(0, 0.3, n)
+    psal = 38.6 - 1.5 * deep * rng.uniform(0, 1, n) + rng.normal(0, 0.1, n)
+    doxy = 180 + 60 * deep * rng.uniform(-1, 1, n) + rng.normal(0, 10, n)
+    return date, lat, lon, pres, temp, psal, doxy
+
+
+def accuracy_report(dtype=np.float32, n=100000, seed=0, basedir=None):
+    # Maximum deviation of the dtype predictions from the float64 ones
+    #
+    # output:
+    # dict of variable name -> dict with
+    #   check      - dtype prediction for the check input
+    #   check_ref  - check value of the CANYON_MED_<var>_v4 function
+    #   check_err  - abs(check - float64 prediction for the check input)
+    #   max_abs    - maximum absolute deviation on the synthetic inputs
+    #   max_rel    - maximum relative deviation on the synthetic inputs
+    #   members_max_abs - maximum absolute deviation of the member outputs
+    variables = list(VARIABLES)
+    inputs = synthetic_inputs(n, seed)
+    ref = predict_all(*inputs, variables=variables, basedir=basedir)
+    low = predict_all(*inputs, variables=variables, basedir=basedir, dtype=dtype)
+    check_ref = predict_all(*CHECK_INPUT, variables=variables, basedir=basedir)
+    check_low = predict_all(*CHECK_INPUT, variables=variables, basedir=basedir, dtype=dtype)
+    X = prepare_inputs(*inputs)
+    X_low = prepare_inputs(*inputs, dtype=dtype)
+
+    report = {}
+    for v in variables:
+        err = np.abs(low[v].astype(np.float64) - ref[v])
+        model = get_model(v, basedir)
+        members_err = np.abs(ensemble_outputs(model, X_low) - ensemble_outputs(model, X))
+        report[v] = {'check': float(check_low[v][0]),
+                     'check_ref': CHECK_VALUES[v],
+                     'check_err': float(abs(check_low[v][0] - check_ref[v][0])),
+                     'max_abs': float(np.nanmax(err)),
+                     'max_rel': float(np.nanmax(err / np.abs(ref[v]))),
+                     'members_max_abs': float(np.nanmax(members_err))}
+    return report
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    report = accuracy_report(np.float32, n)
+    print(f"float32 vs float64 on the check values and {n} synthetic inputs")
+    print(f"{'variable':>8} {'check':>12} {'check_ref':>12} {'check_err':>10} {'max_abs':>10} {'max_rel':>10} {'members':>10}")
+    for v, r in report.items():
+        print(f"{v:>8} {r['check']:12.4f} {r['check_ref']:12.4f} {r['check_err']:10.2e} "
+              f"{r['max_abs']:10.2e} {r['max_rel']:10.2e} {r['members_max_abs']:10.2e}")
@@ -0,0 +1,200 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import CANYON_MED_AT_v4
+import CANYON_MED_CT_v4
+import CANYON_MED_NO3_v4
+import CANYON_MED_PO4_v4
+import CANYON_MED_SiOH4_v4
+import CANYON_MED_pHT_v4
+from CANYON_MED_accuracy import synthetic_inputs
+from CANYON_MED_models import CHECK_INPUT, clear_models, get_model
+
+# Benchmarks of the CANYON-MED functions
+#
+# For each of the 6 CANYON_MED_*_v4 functions, measures
+#   load        - cold start: parsing of the weights
+#   latency     - one point, weights already in memory (median of repeats)
+#   throughput  - rows per second for 1e2 ... 1e7 rows, with the peak
+#                 memory allocated by NumPy during the call
+# and can compare a run with a previous one to catch regressions.
+#
+# The import of the core modules is also timed, in a fresh interpreter:
+# it must only load NumPy (none of HEAVY_MODULES) and stay within
+# IMPORT_BUDGET; --check-import exits with a non-zero status otherwise.
+#
+# usage:
+#   python CANYON_MED_benchmark.py [--max-rows 1e6] [--output run.json]
+#   python CANYON_MED_benchmark.py --compare old.json new.json [--tolerance 0.2]
+#   python CANYON_MED_benchmark.py --check-import
+
+FUNCTIONS = {
+    'AT': CANYON_MED_AT_v4.CANYON_MED_PAT_v4,
+    'CT': CANYON_MED_CT_v4.CANYON_MED_CT_v4,
+    'NO3': CANYON_MED_NO3_v4.CANYON_MED_NO3_v4,
+    'PO4': CANYON_MED_PO4_v4.CANYON_MED_PO4_v4,
+    'SiOH4': CANYON_MED_SiOH4_v4.CANYON_MED_SiOH4_v4,
+    'pHT': CANYON_MED_pHT_v4.CANYON_MED_pHT_v4,
+}
+
+ROWS = [10**k for k in range(2, 8)]
+
+# modules imported by the core inference path (NumPy only)
+CORE_MODULES = ('CANYON_MED_predict', 'CANYON_MED_AT_v4', 'CANYON_MED_CT_v4', 'CANYON_MED_NO3_v4',
+                'CANYON_MED_PO4_v4', 'CANYON_MED_SiOH4_v4', 'CANYON_MED_pHT_v4')
+
+# optional dependencies that the core modules must not import
+HEAVY_MODULES = ('pandas', 'xarray', 'dask', 'numba', 'pyarrow', 'netCDF4', 'scipy')
+
+# maximum import time of the core modules, NumPy included, in s
+IMPORT_BUDGET = 0.5
+
+
+def _timeit(f, repeat):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t)
+    return float(np.median(times))
+
+
+def import_time(modules=CORE_MODULES, repeat=5):
+    # Import time of modules in a fresh interpreter (median of repeat runs)
+    #
+    # output:
+    # (time in s, list of the HEAVY_MODULES the import pulled in)
+    code = ("import sys, time\n"
+            "t = time.perf_counter()\n"
+            f"import {', '.join(modules)}\n"
+            "print(time.perf_counter() - t)\n"
+            f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))\n")
+    times = []
+    for _ in range(repeat):
+        res = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        elapsed, heavy = res.stdout.splitlines()
+        times.append(float(elapsed))
+    return float(np.median(times)), [m for m in heavy.split(',') if m]
+
+
+def benchmark(variables=None, max_rows=10**6, repeat=5, basedir=None):
+    # Run the benchmarks
+    #
+    # output:
+    # dict of variable name -> {'load': s, 'latency': s,
+    #                           'throughput': {rows: {'time': s, 'rows_per_s': .., 'peak_mb': ..}}}
+    if variables is None:
+        variables = list(FUNCTIONS)
+    rows = [n for n in ROWS if n <= max_rows]
+    inputs = synthetic_inputs(rows[-1]) if rows else None
+
+    results = {}
+    for v in variables:
+        f = FUNCTIONS[v]
+
+        clear_models([v])
+        t = time.perf_counter()
+        get_model(v, basedir)
+        load = time.perf_counter() - t
+
+        latency = _timeit(lambda: f(*CHECK_INPUT, basedir=basedir), repeat)
+
+        throughput = {}
+        for n in rows:
+            chunk = [x[:n] for x in inputs]
+            elapsed = _timeit(lambda: f(*chunk, basedir=basedir), 1 if n >= 10**6 else repeat)
+            # separate run, as tracing the allocations slows the call down
+            tracemalloc.start()
+            f(*chunk, basedir=basedir)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            throughput[str(n)] = {'time': elapsed, 'rows_per_s': n / elapsed, 'peak_mb': peak / 2**20}
+        results[v] = {'load': load, 'latency': latency, 'throughput': throughput}
+    return results
+
+
+def compare(old, new, tolerance=0.2):
+    # Relative change of every timing between two benchmark runs
+    #
+    # output:
+    # list of (name, old, new, relative change, regression) where a
+    # regression is a timing more than tolerance slower than before
+    rows = []
+    for v in new:
+        if v not in old:
+            continue
+        pairs = [(f"{v} load", old[v]['load'], new[v]['load']),
+                 (f"{v} latency", old[v]['latency'], new[v]['latency'])]
+        for n, r in new[v]['throughput'].items():
+            if n in old[v]['throughput']:
+                pairs.append((f"{v} {n} rows", old[v]['throughput'][n]['time'], r['time']))
+        for name, a, b in pairs:
+            change = (b - a) / a
+            rows.append((name, a, b, change, change > tolerance))
+    return rows
+
+
+def _print_results(results):
+    for v, r in results.items():
+        print(f"{v}: load {r['load'] * 1e3:.1f} ms, latency {r['latency'] * 1e3:.2f} ms")
+        for n, t in r['throughput'].items():
+            print(f"  {int(n):>9} rows: {t['time']:9.4f} s  {t['rows_per_s']:12.0f} rows/s  peak {t['peak_mb']:8.1f} MB")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CANYON-MED benchmarks")
+    parser.add_argument('--variables', nargs='+', choices=list(FUNCTIONS))
+    parser.add_argument('--max-rows', type=float, default=1e6)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--basedir')
+    parser.add_argument('--output', help="save the results as JSON")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="compare two saved runs instead of running the benchmarks")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="relative slowdown reported as a regression (default 0.2)")
+    parser.add_argument('--check-import', action='store_true',
+                        help="only check the import time and dependencies of the core modules")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        rows = compare(old['results'], new['results'], args.tolerance)
+        if 'import' in old and 'import' in new:
+            change = (new['import'] - old['import']) / old['import']
+            rows.insert(0, ('import', old['import'], new['import'], change, change > args.tolerance))
+        regressions = 0
+        for name, a, b, change, regression in rows:
+            regressions += regression
+            print(f"{name:>22}: {a:10.4f} s -> {b:10.4f} s  {change:+7.1%}{'  REGRESSION' if regression else ''}")
+        return 1 if regressions else 0
+
+    elapsed, heavy = import_time()
+    over = elapsed > IMPORT_BUDGET or heavy
+    print(f"import: {elapsed * 1e3:.1f} ms (budget {IMPORT_BUDGET * 1e3:.0f} ms)"
+          f"{', imports ' + ', '.join(heavy) if heavy else ''}{'  OVER BUDGET' if over else ''}")
+    if args.check_import:
+        return 1 if over else 0
+
+    results = benchmark(args.variables, int(args.max_rows), args.repeat, args.basedir)
+    _print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': sys.version, 'numpy': np.__version__,
+                       'machine': platform.platform(), 'import': elapsed, 'results': results}, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
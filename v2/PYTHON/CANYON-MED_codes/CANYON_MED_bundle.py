@@ -0,0 +1,178 @@
+import hashlib
+import os
+import sys
+import zipfile
+
+import numpy as np
+
+from CANYON_MED_models import (VARIABLES, SUBSETS, CHECK_VALUES, CanyonMedModel,
+                               load_model, n_list)
+
+# Binary bundle of the CANYON-MED weights
+#
+# The text files in "CANYON-MED_weights" remain the source of truth; this
+# module compiles them into a single uncompressed .npz file that can be
+# memory-mapped, so that loading the networks costs one file open instead
+# of hundreds of text files to tokenise.
+#
+# bundle layout (one .npy entry per array):
+#   __version__              - BUNDLE_VERSION
+#   <var>/moy_<s>, std_<s>   - normalisation statistics of subset s
+#   <var>/<w>_<s>_<i>        - weights w in (IW, b1, LW1, b2, LW2, b3) of member i
+#   <var>/check_value        - check value of the CANYON_MED_<var>_v4 function
+#   <var>/sha256             - checksum of the arrays above
+#
+# to convert the text weights:
+#   python CANYON_MED_bundle.py /path/to/PYTHON/ [bundle.npz]
+
+BUNDLE_VERSION = 1
+WEIGHTS = ('IW', 'b1', 'LW1', 'b2', 'LW2', 'b3')
+
+
+class CanyonMedBundle:
+    # Models read from a bundle, indexed by variable name
+
+    def __init__(self, path, version, models, check_values, checksums):
+        self.path = path
+        self.version = version
+        self.models = models
+        self.check_values = check_values
+        self.checksums = checksums
+
+    def __getitem__(self, variable):
+        return self.models[variable]
+
+    def __contains__(self, variable):
+        return variable in self.models
+
+    def __repr__(self):
+        return f"CanyonMedBundle({self.path!r}, variables={list(self.models)})"
+
+
+def _model_arrays(model):
+    # arrays of one model, in the bundle order
+    arrays = {}
+    for s in SUBSETS:
+        arrays[f"moy_{s}"] = model.moy[s]
+        arrays[f"std_{s}"] = model.std[s]
+        for i, member in enumerate(model.members[s], start=1):
+            for w, x in zip(WEIGHTS, member):
+                arrays[f"{w}_{s}_{i}"] = x
+    return arrays
+
+
+def _checksum(arrays):
+    h = hashlib.sha256()
+    for name, x in arrays.items():
+        h.update(name.encode())
+        h.update(str(x.shape).encode())
+        h.update(np.ascontiguousarray(x, dtype='<f8').tobytes())
+    return h.hexdigest()
+
+
+def write_bundle(basedir, path=None):
+    # Compile the text weights of basedir + "CANYON-MED_weights/" into a bundle
+    #
+    # input:
+    # basedir - path to the CANYON-MED folder (ending in "PYTHON/")
+    # path    - output file, default basedir + "CANYON-MED_weights.npz"
+    #
+    # output:
+    # path of the written bundle
+    if path is None:
+        path = os.path.join(basedir, "CANYON-MED_weights.npz")
+
+    entries = {'__version__': np.array(BUNDLE_VERSION)}
+    for v in VARIABLES:
+        arrays = _model_arrays(load_model(v, basedir))
+        for name, x in arrays.items():
+            entries[f"{v}/{name}"] = np.ascontiguousarray(x, dtype='<f8')
+        entries[f"{v}/check_value"] = np.array(CHECK_VALUES[v])
+        entries[f"{v}/sha256"] = np.array(_checksum(arrays))
+
+    # savez stores the entries uncompressed, which keeps them memory-mappable
+    tmp = path + ".tmp"
+    with open(tmp, 'wb') as f:
+        np.savez(f, **entries)
+    os.replace(tmp, path)
+    return path
+
+
+def _read_entries(path, mmap):
+    # name -> array for every entry of the bundle, as read-only views on a
+    # single memory map of the file when mmap is True
+    entries = {}
+    if not mmap:
+        with np.load(path) as npz:
+            for name in npz.files:
+                entries[name] = npz[name]
+        return entries
+
+    buf = np.memmap(path, dtype=np.uint8, mode='r')
+    with zipfile.ZipFile(path) as zf, open(path, 'rb') as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{path}: entry {info.filename} is compressed and cannot be memory-mapped")
+            # skip the local file header: 30 bytes + file name + extra field
+            f.seek(info.header_offset + 26)
+            n_name, n_extra = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(info.header_offset + 30 + int(n_name) + int(n_extra))
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise ValueError(f"{path}: entry {info.filename} holds Python objects")
+            x = np.ndarray(shape, dtype=dtype, buffer=buf, offset=f.tell(),
+                           order='F' if fortran_order else 'C')
+            entries[info.filename[:-len('.npy')]] = x
+    return entries
+
+
+def load_bundle(path, variables=None, mmap=True, verify=True):
+    # Load CANYON-MED models from a bundle written by write_bundle
+    #
+    # input:
+    # path      - bundle file
+    # variables - names of the variables to load, default all
+    # mmap      - memory-map the file instead of reading it
+    # verify    - check the stored checksum of every loaded variable
+    #
+    # output:
+    # CanyonMedBundle
+    entries = _read_entries(path, mmap)
+    version = int(entries['__version__'])
+    if version != BUNDLE_VERSION:
+        raise ValueError(f"{path}: bundle version {version}, expected {BUNDLE_VERSION}")
+    if variables is None:
+        variables = [v for v in VARIABLES if f"{v}/sha256" in entries]
+
+    models, check_values, checksums = {}, {}, {}
+    for v in variables:
+        if f"{v}/sha256" not in entries:
+            raise KeyError(f"{path}: no weights for variable {v!r}")
+        arrays = {}
+        for s in SUBSETS:
+            arrays[f"moy_{s}"] = entries[f"{v}/moy_{s}"]
+            arrays[f"std_{s}"] = entries[f"{v}/std_{s}"]
+            for i in range(1, n_list + 1):
+                for w in WEIGHTS:
+                    arrays[f"{w}_{s}_{i}"] = entries[f"{v}/{w}_{s}_{i}"]
+        checksums[v] = str(entries[f"{v}/sha256"])
+        if verify and _checksum(arrays) != checksums[v]:
+            raise ValueError(f"{path}: checksum mismatch for variable {v!r}")
+
+        moy = {s: arrays[f"moy_{s}"] for s in SUBSETS}
+        std = {s: arrays[f"std_{s}"] for s in SUBSETS}
+        members = {s: [tuple(arrays[f"{w}_{s}_{i}"] for w in WEIGHTS)
+                       for i in range(1, n_list + 1)] for s in SUBSETS}
+        models[v] = CanyonMedModel(v, moy, std, members)
+        check_values[v] = float(entries[f"{v}/check_value"])
+    return CanyonMedBundle(path, version, models, check_values, checksums)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        sys.exit("usage: python CANYON_MED_bundle.py basedir [bundle.npz]")
+    print(write_bundle(*sys.argv[1:]))
@@ -0,0 +1,173 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from CANYON_MED_models import ne
+from CANYON_MED_predict import (_variables, calculate_decimal_year, predict_variable,
+                                prepare_features)
+
+# Memoising cache in front of the CANYON-MED predictions
+#
+# The inputs (decimal year, lat, lon, pres, temp, psal, doxy) are rounded
+# to a configurable resolution; the predictions of all cached variables
+# for a rounded input are computed once, at the rounded values, and then
+# served from memory. The cache holds at most maxsize inputs and evicts
+# the least recently used ones. It can be saved to and reloaded from disk.
+#
+# for example
+# cache = PredictionCache(maxsize=100000, path='canyon_med_cache.npz')
+# cache.predict(['2014-04-09'], [35], [18], [500], [13.5], [38.6], [160])['NO3']
+# cache.save()
+
+# resolution of the cache keys, in the units of the inputs
+DEFAULT_RESOLUTION = {'dec_year': 1 / 365, 'lat': 1e-3, 'lon': 1e-3, 'pres': 0.1,
+                      'temp': 1e-3, 'psal': 1e-3, 'doxy': 0.01}
+
+# order of the inputs in the keys (the order of the network inputs)
+KEY_ORDER = ('lat', 'lon', 'dec_year', 'temp', 'psal', 'doxy', 'pres')
+
+
+class PredictionCache:
+    # LRU cache of CANYON-MED predictions
+    #
+    # input:
+    # variables  - variables computed and cached for every input, default all
+    # resolution - dict of input name -> rounding step, default
+    #              DEFAULT_RESOLUTION (missing names keep their default)
+    # maxsize    - maximum number of cached inputs
+    # path       - optional .npz file the cache is loaded from (if it
+    #              exists) and saved to by save()
+    # basedir    - location of the weights, as in predict_all
+    # convention - decimal year convention of the keys, 'fixed' (default)
+    #              or 'leap', see calculate_decimal_year
+
+    def __init__(self, variables=None, resolution=None, maxsize=1000000, path=None, basedir=None,
+                 convention='fixed'):
+        self.variables = _variables(variables)
+        res = dict(DEFAULT_RESOLUTION)
+        res.update(resolution or {})
+        self.resolution = res
+        self._step = np.array([res[k] for k in KEY_ORDER])
+        self.maxsize = maxsize
+        self.path = path
+        self.basedir = basedir
+        self.convention = convention
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        # hit/miss counters, in rows
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self._entries), 'maxsize': self.maxsize,
+                'hit_rate': self.hits / total if total else 0.0}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def predict(self, date, lat, lon, pres, temp, psal, doxy, variables=None,
+                date_type='datetime', convention=None):
+        # predict_all through the cache; variables must be cached variables
+        #
+        # date_type  - as in predict_all
+        # convention - as in predict_all, default the convention of the cache
+        #
+        # output:
+        # dict of variable name -> array of predictions (NaN for rows with
+        # non-finite inputs)
+        variables = _variables(variables) if variables is not None else self.variables
+        columns = [self.variables.index(v) for v in variables]
+
+        if convention is None:
+            convention = self.convention
+        dec_year = calculate_decimal_year(date, date_type, convention)
+        raw = prepare_raw(dec_year, lat, lon, pres, temp, psal, doxy)
+        out = np.full((raw.shape[0], len(self.variables)), np.nan)
+        finite = np.all(np.isfinite(raw), axis=1)
+        keys = np.round(raw[finite] / self._step).astype(np.int64)
+        if keys.shape[0]:
+            unique, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+            values = np.empty((unique.shape[0], len(self.variables)))
+            missing = []
+            with self._lock:
+                for i, key in enumerate(unique):
+                    value = self._entries.get(key.tobytes())
+                    if value is None:
+                        missing.append(i)
+                    else:
+                        self._entries.move_to_end(key.tobytes())
+                        values[i] = value
+                        self.hits += int(counts[i])
+            if missing:
+                values[missing] = self._compute(unique[missing])
+                with self._lock:
+                    for i in missing:
+                        self._entries[unique[i].tobytes()] = values[i].copy()
+                        self.misses += int(counts[i])
+                    while len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)
+                        self.evictions += 1
+            out[finite] = values[inverse.ravel()]
+        return {v: out[:, j] for v, j in zip(variables, columns)}
+
+    def _compute(self, keys):
+        # predictions at the rounded inputs
+        raw = keys * self._step
+        X = prepare_features(raw[:, 2], raw[:, 0], raw[:, 1], raw[:, 6], raw[:, 3], raw[:, 4], raw[:, 5])
+        return np.column_stack([predict_variable(v, X, self.basedir) for v in self.variables])
+
+    def save(self, path=None):
+        # write the cached entries (most recently used last) to a .npz file
+        path = path or self.path
+        if path is None:
+            raise ValueError("no path given to save the cache")
+        with self._lock:
+            keys = np.array([np.frombuffer(k, dtype=np.int64) for k in self._entries]).reshape(-1, ne)
+            values = np.array(list(self._entries.values())).reshape(-1, len(self.variables))
+        np.savez(path, keys=keys, values=values, step=self._step,
+                 variables=np.array(self.variables), convention=self.convention)
+        return path
+
+    def load(self, path):
+        # add the entries of a cache saved with the same variables, resolution
+        # and convention (caches saved without a convention used 'fixed')
+        with np.load(path) as f:
+            convention = str(f['convention']) if 'convention' in f.files else 'fixed'
+            if (list(f['variables']) != self.variables or not np.array_equal(f['step'], self._step)
+                    or convention != self.convention):
+                raise ValueError(f"{path}: cache saved with other variables, resolution or convention")
+            keys, values = f['keys'], f['values']
+        with self._lock:
+            for key, value in zip(keys, values):
+                self._entries[key.tobytes()] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+def prepare_raw(dec_year, lat, lon, pres, temp, psal, doxy):
+    # (n, ne) untransformed inputs in the order of KEY_ORDER, with the
+    # longitude converted to -180; 180 so that both conventions share keys
+    dec_year = np.atleast_1d(dec_year)
+    raw = np.empty((dec_year.size, ne))
+    raw[:, 0] = lat
+    raw[:, 1] = lon
+    raw[:, 2] = dec_year
+    raw[:, 3] = temp
+    raw[:, 4] = psal
+    raw[:, 5] = doxy
+    raw[:, 6] = pres
+    lon = raw[:, 1]
+    lon[lon > 180] -= 360
+    return raw
@@ -0,0 +1,230 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from CANYON_MED_models import VARIABLES, set_basedir
+from CANYON_MED_predict import INPUTS, predict_all
+from CANYON_MED_validate import predict_validated
+
+# canyon-med: file-to-file CANYON-MED predictions
+#
+# Reads a CSV, Parquet or NetCDF file chunk by chunk, predicts the
+# requested variables and writes every chunk to the output file as soon as
+# it is computed, so that files larger than memory can be processed.
+# The format of each file is given by its extension (.csv, .parquet/.pq,
+# .nc/.nc4). CSV and Parquet outputs keep all the input columns; NetCDF
+# outputs hold the input and predicted variables along an "obs" dimension.
+#
+# pandas is needed for CSV, pyarrow for Parquet and xarray + netCDF4 for
+# NetCDF.
+#
+# With --validate, the rows with missing, out of range or out of domain
+# inputs are not computed (NaN) and a "status" column gives the reason
+# (see CANYON_MED_validate).
+#
+# usage:
+#   python CANYON_MED_cli.py input.csv output.parquet
+#       [--variables NO3 PO4] [--columns date=JULD lat=LATITUDE lon=LONGITUDE ...]
+#       [--chunk-size 100000] [--date-type juld] [--basedir /path/to/PYTHON/] [--validate]
+
+
+def _format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.csv', '.txt'):
+        return 'csv'
+    if ext in ('.parquet', '.pq'):
+        return 'parquet'
+    if ext in ('.nc', '.nc4', '.cdf', '.netcdf'):
+        return 'netcdf'
+    raise ValueError(f"{path}: unknown file format {ext!r}, expected .csv, .parquet or .nc")
+
+
+def _require(module, purpose):
+    try:
+        return __import__(module)
+    except ImportError:
+        raise ImportError(f"{module} is required to {purpose}") from None
+
+
+def read_chunks(path, columns, chunk_size):
+    # Chunks of the input file, as dicts of column name -> array
+    #
+    # columns - input name -> column name in the file
+    fmt = _format(path)
+    if fmt == 'csv':
+        pd = _require('pandas', "read CSV files")
+        for df in pd.read_csv(path, chunksize=chunk_size):
+            yield {c: df[c].to_numpy() for c in df.columns}
+    elif fmt == 'parquet':
+        _require('pyarrow', "read Parquet files")
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield {name: col.to_numpy(zero_copy_only=False)
+                   for name, col in zip(batch.schema.names, batch.columns)}
+    else:
+        xr = _require('xarray', "read NetCDF files")
+        with xr.open_dataset(path) as ds:
+            names = list(columns.values())
+            dims = {ds[c].dims for c in names}
+            if len(dims) != 1 or len(next(iter(dims))) != 1:
+                raise ValueError(f"{path}: the input variables {names} must share a single dimension "
+                                 "(see CANYON_MED_xarray for gridded fields)")
+            dim = next(iter(dims))[0]
+            for i in range(0, ds.sizes[dim], chunk_size):
+                sub = ds[names].isel({dim: slice(i, i + chunk_size)})
+                yield {c: sub[c].values for c in names}
+
+
+class _CsvWriter:
+    def __init__(self, path):
+        self.pd = _require('pandas', "write CSV files")
+        self.path = path
+        self.header = True
+
+    def write(self, chunk):
+        self.pd.DataFrame(chunk).to_csv(self.path, mode='w' if self.header else 'a',
+                                        header=self.header, index=False)
+        self.header = False
+
+    def close(self):
+        pass
+
+
+class _ParquetWriter:
+    def __init__(self, path):
+        self.pa = _require('pyarrow', "write Parquet files")
+        import pyarrow.parquet as pq
+        self.pq = pq
+        self.path = path
+        self.writer = None
+
+    def write(self, chunk):
+        table = self.pa.table(chunk)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class _NetcdfWriter:
+    # appends the chunks along an unlimited "obs" dimension; datetimes are
+    # stored as seconds since 1970-01-01, other non-numeric columns are skipped
+    def __init__(self, path):
+        netCDF4 = _require('netCDF4', "write NetCDF files")
+        self.ds = netCDF4.Dataset(path, 'w')
+        self.ds.createDimension('obs', None)
+        self.n = 0
+
+    def write(self, chunk):
+        m = len(next(iter(chunk.values())))
+        for name, x in chunk.items():
+            x = np.asarray(x)
+            if x.dtype.kind == 'M':
+                x = x.astype('datetime64[s]').astype(np.float64)
+                if name not in self.ds.variables:
+                    self.ds.createVariable(name, 'f8', ('obs',)).units = "seconds since 1970-01-01 00:00:00"
+            elif x.dtype.kind not in 'fiub':
+                continue
+            elif name not in self.ds.variables:
+                self.ds.createVariable(name, x.dtype, ('obs',))
+            self.ds.variables[name][self.n:self.n + m] = x
+        self.n += m
+
+    def close(self):
+        self.ds.close()
+
+
+WRITERS = {'csv': _CsvWriter, 'parquet': _ParquetWriter, 'netcdf': _NetcdfWriter}
+
+
+def run(input, output, variables=None, columns=None, chunk_size=100000, dtype=np.float64,
+        date_type='datetime', convention='fixed', basedir=None, log=sys.stderr, validate=False):
+    # Predict the variables for every row of input and write them to output
+    #
+    # input, output - file paths (.csv, .parquet or .nc)
+    # variables     - variables to predict, default all six
+    # columns       - dict of input name (date, lat, ...) -> column name in
+    #                 the input file, default the input names themselves
+    # chunk_size    - number of rows read, predicted and written at a time
+    # log           - stream for the progress report (None for silence)
+    # validate      - skip the invalid rows and add their status column
+    #
+    # output:
+    # number of rows processed
+    variables = list(VARIABLES) if variables is None else list(variables)
+    mapping = {name: name for name in INPUTS}
+    mapping.update(columns or {})
+    writer = WRITERS[_format(output)](output)
+
+    n = 0
+    start = time.perf_counter()
+    try:
+        for chunk in read_chunks(input, mapping, chunk_size):
+            missing = [c for c in mapping.values() if c not in chunk]
+            if missing:
+                raise KeyError(f"{input}: missing input columns {missing}")
+            inputs = [chunk[mapping[name]] for name in INPUTS]
+            if validate:
+                res, status = predict_validated(*inputs, variables=variables, basedir=basedir,
+                                                dtype=dtype, date_type=date_type, convention=convention)
+                chunk['status'] = status
+            else:
+                res = predict_all(*inputs, variables=variables, basedir=basedir, dtype=dtype,
+                                  date_type=date_type, convention=convention)
+            chunk.update(res)
+            writer.write(chunk)
+            n += len(res[variables[0]])
+            if log is not None:
+                elapsed = time.perf_counter() - start
+                print(f"{n} rows, {n / elapsed:.0f} rows/s", file=log)
+    finally:
+        writer.close()
+    return n
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='canyon-med',
+                                     description="CANYON-MED predictions from CSV, Parquet or NetCDF files")
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--variables', nargs='+', choices=list(VARIABLES),
+                        help="variables to predict (default: all)")
+    parser.add_argument('--columns', nargs='+', default=[], metavar='NAME=COLUMN',
+                        help=f"column of each input in the file, NAME in {', '.join(INPUTS)}")
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--float32', action='store_true', help="single precision computations")
+    parser.add_argument('--date-type', default='datetime', choices=['datetime', 'jd', 'juld'])
+    parser.add_argument('--convention', default='fixed', choices=['fixed', 'leap'])
+    parser.add_argument('--basedir', help="location of the weights (folder or .npz bundle)")
+    parser.add_argument('--validate', action='store_true',
+                        help="skip rows with invalid inputs and write their status")
+    parser.add_argument('--quiet', action='store_true')
+    args = parser.parse_args(argv)
+
+    columns = {}
+    for item in args.columns:
+        name, sep, column = item.partition('=')
+        if not sep or name not in INPUTS:
+            parser.error(f"--columns: expected NAME=COLUMN with NAME in {INPUTS}, got {item!r}")
+        columns[name] = column
+    if args.basedir:
+        set_basedir(args.basedir)
+
+    start = time.perf_counter()
+    n = run(args.input, args.output, args.variables, columns, args.chunk_size,
+            np.float32 if args.float32 else np.float64, args.date_type, args.convention,
+            log=None if args.quiet else sys.stderr, validate=args.validate)
+    elapsed = time.perf_counter() - start
+    print(f"{args.output}: {n} rows in {elapsed:.1f} s ({n / max(elapsed, 1e-9):.0f} rows/s)",
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import threading
+from contextlib import contextmanager
+
+# Timing and counters of the CANYON-MED computation stages
+#
+# The engine reports, for every call, the wall time and the number of rows
+# of each stage:
+#   load      - parsing of the weights of a variable (rows = 0)
+#   dates     - conversion of the dates to decimal years
+#   preprocess - longitude wrap, pressure transform and feature matrix
+#   forward   - forward pass of the 10 members of a variable
+#   aggregate - +/- 1 std filtered mean of a variable
+# to the callbacks registered with add_hook, as
+# callback(stage, variable, seconds, rows) (variable is None for the
+# stages shared by all variables). Nothing is timed while no callback is
+# registered.
+#
+# StageSummary is a callback accumulating the calls, rows and time of each
+# stage; it can be printed or exported as Prometheus counters.
+#
+# for example
+# with collect() as summary:
+#     predict_all(...)
+# print(summary)
+
+STAGES = ('load', 'dates', 'preprocess', 'forward', 'aggregate')
+
+_hooks = []
+
+
+def add_hook(callback):
+    # Call callback(stage, variable, seconds, rows) after every stage
+    _hooks.append(callback)
+    return callback
+
+
+def remove_hook(callback):
+    _hooks.remove(callback)
+
+
+def active():
+    # True if the stages are to be timed
+    return bool(_hooks)
+
+
+def record(stage, variable, seconds, rows):
+    for callback in list(_hooks):
+        callback(stage, variable, seconds, rows)
+
+
+class StageSummary:
+    # Accumulated calls, rows and seconds per (stage, variable), safe to use
+    # from several threads
+    #
+    # for a long-running process
+    # summary = add_hook(StageSummary())
+    # ... summary.to_prometheus() on each scrape
+
+    def __init__(self):
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, stage, variable, seconds, rows):
+        with self._lock:
+            c = self.counters.setdefault((stage, variable), [0, 0, 0.0])
+            c[0] += 1
+            c[1] += rows
+            c[2] += seconds
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+
+    def total(self, stage=None):
+        # total seconds, of one stage or of all of them
+        with self._lock:
+            return sum(c[2] for (s, _), c in self.counters.items() if stage is None or s == stage)
+
+    def as_dict(self):
+        # {(stage, variable): {'calls': .., 'rows': .., 'seconds': ..}}
+        with self._lock:
+            return {k: {'calls': c[0], 'rows': c[1], 'seconds': c[2]} for k, c in self.counters.items()}
+
+    def _sorted(self):
+        order = {s: i for i, s in enumerate(STAGES)}
+        return sorted(self.as_dict().items(), key=lambda kv: (order.get(kv[0][0], len(order)), kv[0][1] or ''))
+
+    def __str__(self):
+        total = self.total()
+        lines = [f"{'stage':>10} {'variable':>8} {'calls':>8} {'rows':>12} {'seconds':>10} {'share':>6}"]
+        for (stage, variable), c in self._sorted():
+            share = c['seconds'] / total if total else 0.0
+            lines.append(f"{stage:>10} {variable or '-':>8} {c['calls']:8d} {c['rows']:12d} "
+                         f"{c['seconds']:10.4f} {share:6.1%}")
+        return '\n'.join(lines)
+
+    def to_prometheus(self, prefix='canyon_med'):
+        # The counters in the Prometheus text exposition format
+        lines = []
+        items = self._sorted()
+        for name, field, help in (('stage_calls_total', 'calls', "Number of calls of each stage"),
+                                  ('stage_rows_total', 'rows', "Rows processed by each stage"),
+                                  ('stage_seconds_total', 'seconds', "Wall time spent in each stage")):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            for (stage, variable), c in items:
+                lines.append(f'{prefix}_{name}{{stage="{stage}",variable="{variable or ""}"}} {c[field]}')
+        return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def collect(summary=None):
+    # Record the stages of the calls made within the with block into a
+    # StageSummary (a new one by default)
+    summary = StageSummary() if summary is None else summary
+    add_hook(summary)
+    try:
+        yield summary
+    finally:
+        remove_hook(summary)
@@ -0,0 +1,256 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+import CANYON_MED_instrument as instrument
+
+# In-memory registry of the CANYON-MED networks
+#
+# Each CANYON-MED variable is an ensemble of 10 multi-layer perceptrons
+# trained on two subsets of the data (F and G, 5 members each). The
+# weights are stored as text files in the "CANYON-MED_weights" folder;
+# they are parsed once per process and served from memory afterwards.
+
+# variable name -> prefix of the weight files in CANYON-MED_weights/
+VARIABLES = {'AT': 'AT', 'CT': 'CT', 'NO3': 'nit', 'PO4': 'phos', 'SiOH4': 'sil', 'pHT': 'ph'}
+
+SUBSETS = ('F', 'G')  # training subsets
+n_list = 5  # number of members per subset
+ne = 7  # number of inputs
+
+# check values of the CANYON_MED_*_v4 functions
+# for 09-Apr-2014, 35° N, 18° E, 500 dbar, 13.5 °C, 38.6 psu, 160 umol O2 kg-1
+CHECK_INPUT = (['2014-04-09'], [35], [18], [500], [13.5], [38.6], [160])
+CHECK_VALUES = {'AT': 2599.3535, 'CT': 2314.4897, 'NO3': 5.9115, 'PO4': 0.3029, 'SiOH4': 6.6340, 'pHT': 8.0965}
+
+
+# names of the packed tensors of CanyonMedModel
+PACKED = ('IW', 'b1', 'LW1', 'b2', 'LW2', 'b3', 'moy_in', 'std_in', 'moy_out', 'std_out')
+
+
+class CanyonMedModel:
+    # Weights of one CANYON-MED variable
+    #
+    # moy[s], std[s]  - normalisation statistics of subset s, shape (1, ne+1)
+    #                   (ne inputs followed by the output)
+    # members[s]      - list of n_list tuples (IW, b1, LW1, b2, LW2, b3)
+    #
+    # For the batched forward pass the members are also packed into stacked
+    # tensors of shape (len(SUBSETS), n_list, ...), zero-padded to the
+    # largest hidden layers (padded neurons output 0 and carry no weight):
+    # IW (.., ne, h1), b1 (.., 1, h1), LW1 (.., h1, h2), b2 (.., 1, h2),
+    # LW2 (.., h2, 1), b3 (.., 1, 1); moy_in/std_in (len(SUBSETS), 1, 1, ne)
+    # and moy_out/std_out (len(SUBSETS), 1) hold the normalisation statistics
+
+    def __init__(self, variable, moy, std, members):
+        self.variable = variable
+        self.moy = moy
+        self.std = std
+        self.members = members
+        self._pack()
+        self._cast = {}
+
+    def _pack(self):
+        h1 = max(m[0].shape[0] for s in SUBSETS for m in self.members[s])
+        h2 = max(m[2].shape[0] for s in SUBSETS for m in self.members[s])
+        shape = (len(SUBSETS), n_list)
+        self.IW = np.zeros(shape + (ne, h1))
+        self.b1 = np.zeros(shape + (1, h1))
+        self.LW1 = np.zeros(shape + (h1, h2))
+        self.b2 = np.zeros(shape + (1, h2))
+        self.LW2 = np.zeros(shape + (h2, 1))
+        self.b3 = np.zeros(shape + (1, 1))
+        for k, s in enumerate(SUBSETS):
+            for i, (IW, b1, LW1, b2, LW2, b3) in enumerate(self.members[s]):
+                n1, n2 = IW.shape[0], LW1.shape[0]
+                self.IW[k, i, :, :n1] = IW.T
+                self.b1[k, i, 0, :n1] = b1[:, 0]
+                self.LW1[k, i, :n1, :n2] = LW1.T
+                self.b2[k, i, 0, :n2] = b2[:, 0]
+                self.LW2[k, i, :n2, 0] = LW2[0]
+                self.b3[k, i] = b3
+        self.moy_in = np.array([self.moy[s][0, :ne] for s in SUBSETS])[:, None, None, :]
+        self.std_in = np.array([self.std[s][0, :ne] for s in SUBSETS])[:, None, None, :]
+        self.moy_out = np.array([[self.moy[s][0, ne]] for s in SUBSETS])
+        self.std_out = np.array([[self.std[s][0, ne]] for s in SUBSETS])
+
+    @classmethod
+    def from_packed(cls, variable, packed, sizes):
+        # Model on existing packed tensors (e.g. in shared memory) without
+        # copying them: the per-member weights are views of the tensors
+        #
+        # packed - dict of name in PACKED -> tensor
+        # sizes  - sizes[k][i] = (h1, h2) hidden layer sizes of member i of
+        #          subset k
+        model = object.__new__(cls)
+        model.variable = variable
+        for name in PACKED:
+            setattr(model, name, packed[name])
+        model.moy, model.std, model.members = {}, {}, {}
+        for k, s in enumerate(SUBSETS):
+            model.moy[s] = np.append(model.moy_in[k, 0, 0], model.moy_out[k])[None, :]
+            model.std[s] = np.append(model.std_in[k, 0, 0], model.std_out[k])[None, :]
+            model.members[s] = [(model.IW[k, i, :, :n1].T, model.b1[k, i, :, :n1].T,
+                                 model.LW1[k, i, :n1, :n2].T, model.b2[k, i, :, :n2].T,
+                                 model.LW2[k, i, :n2].T, model.b3[k, i])
+                                for i, (n1, n2) in enumerate(sizes[k])]
+        model._cast = {}
+        return model
+
+    def sizes(self):
+        # hidden layer sizes (h1, h2) of each member, as taken by from_packed
+        return [[(m[0].shape[0], m[2].shape[0]) for m in self.members[s]] for s in SUBSETS]
+
+    def astype(self, dtype):
+        # The model with its packed tensors cast to dtype (cached; the
+        # per-member weights are kept in float64)
+        dtype = np.dtype(dtype)
+        if dtype == np.float64:
+            return self
+        cast = self._cast.get(dtype)
+        if cast is None:
+            cast = object.__new__(CanyonMedModel)
+            cast.__dict__.update(self.__dict__)
+            for name in PACKED:
+                setattr(cast, name, getattr(self, name).astype(dtype))
+            cast._cast = {}
+            self._cast[dtype] = cast
+        return cast
+
+    def __repr__(self):
+        return f"CanyonMedModel({self.variable!r})"
+
+
+def _read_weights(path):
+    # all CANYON-MED weight files are whitespace-delimited float matrices
+    return np.loadtxt(path, ndmin=2)
+
+
+_bundles = {}
+
+
+def _load_bundle(path):
+    # the bundle at path, read on first use only
+    key = os.path.abspath(path)
+    bundle = _bundles.get(key)
+    if bundle is None:
+        from CANYON_MED_bundle import load_bundle
+        bundle = _bundles[key] = load_bundle(path)
+    return bundle
+
+
+def load_model(variable, basedir):
+    # Parse the weights of one variable from basedir + "CANYON-MED_weights/"
+    #
+    # input:
+    # variable - one of VARIABLES ('AT', 'CT', 'NO3', 'PO4', 'SiOH4', 'pHT')
+    # basedir  - path to the CANYON-MED folder (ending in "PYTHON/")
+    #
+    # output:
+    # CanyonMedModel
+    #
+    # basedir may also be the path of a binary bundle written by
+    # CANYON_MED_bundle.write_bundle (a file ending in ".npz"), read once
+    # for all its variables
+    if os.fspath(basedir).endswith('.npz'):
+        return _load_bundle(basedir)[variable]
+    if variable not in VARIABLES:
+        raise ValueError(f"unknown CANYON-MED variable {variable!r}, expected one of {list(VARIABLES)}")
+    prefix = VARIABLES[variable]
+    weights = os.path.join(basedir, "CANYON-MED_weights")
+
+    moy, std, members = {}, {}, {}
+    for s in SUBSETS:
+        moy[s] = _read_weights(os.path.join(weights, f"moy_{prefix}_{s}.txt"))
+        std[s] = _read_weights(os.path.join(weights, f"std_{prefix}_{s}.txt"))
+        members[s] = []
+        for i in range(1, n_list + 1):
+            members[s].append(tuple(
+                _read_weights(os.path.join(weights, f"poids_{prefix}_{w}_{s}_{i}.txt"))
+                for w in ('IW', 'b1', 'LW1', 'b2', 'LW2', 'b3')))
+    return CanyonMedModel(variable, moy, std, members)
+
+
+# Location of the weights
+#
+# The weights are looked up, in order of precedence, in
+#   1. the basedir argument of the prediction functions,
+#   2. the location set with set_basedir(),
+#   3. the CANYON_MED_BASEDIR environment variable,
+#   4. the folder containing "CANYON-MED_codes" (the "PYTHON/" folder of
+#      this repository).
+# A location is either a CANYON-MED folder, the path of a binary bundle
+# (".npz", see CANYON_MED_bundle) or an already loaded CanyonMedBundle.
+# The default location is resolved once per process.
+
+ENV_BASEDIR = 'CANYON_MED_BASEDIR'
+
+_default_basedir = None
+
+
+def package_basedir():
+    # the "PYTHON/" folder next to this file's "CANYON-MED_codes" folder
+    return os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def set_basedir(basedir):
+    # Set the process-wide location of the weights (None to look it up again)
+    global _default_basedir
+    _default_basedir = basedir
+
+
+def resolve_basedir(basedir=None):
+    # Return the location of the weights to use for an optional basedir
+    global _default_basedir
+    if basedir is not None:
+        return basedir
+    if _default_basedir is None:
+        _default_basedir = os.environ.get(ENV_BASEDIR) or package_basedir()
+    return _default_basedir
+
+
+_models = {}
+_lock = threading.Lock()
+
+
+def get_model(variable, basedir=None):
+    # Return the weights of variable, parsing them on first use only
+    basedir = resolve_basedir(basedir)
+    if not isinstance(basedir, (str, os.PathLike)):
+        # pre-loaded bundle
+        return basedir[variable]
+
+    key = (os.path.abspath(basedir), variable)
+    model = _models.get(key)
+    if model is None:
+        with _lock:
+            model = _models.get(key)
+            if model is None:
+                timing = instrument.active()
+                if timing:
+                    t = time.perf_counter()
+                model = load_model(variable, basedir)
+                if timing:
+                    instrument.record('load', variable, time.perf_counter() - t, 0)
+                _models[key] = model
+    return model
+
+
+def clear_models(variables=None):
+    # Drop cached weights (all of them, or only those of the given variables)
+    # so that the next call re-reads the weight files
+    with _lock:
+        _bundles.clear()
+        for key in list(_models):
+            if variables is None or key[1] in variables:
+                del _models[key]
+
+
+def reload_models(basedir=None, variables=None):
+    # Re-read the weight files of the given variables (default: all six)
+    if variables is None:
+        variables = list(VARIABLES)
+    clear_models(variables)
+    return {v: get_model(v, basedir) for v in variables}
@@ -0,0 +1,234 @@
+import math
+import time
+
+import numpy as np
+
+import CANYON_MED_instrument as instrument
+from CANYON_MED_models import SUBSETS, VARIABLES, get_model
+from CANYON_MED_predict import _variables, calculate_decimal_year, predict_all
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# Fused CANYON-MED kernel compiled with Numba (optional)
+#
+# After the dates are converted to decimal years (in NumPy), one compiled
+# loop does everything else without intermediate arrays of the size of the
+# input: the longitude wrap, the pressure transform, the normalisation,
+# the two hidden layers of the 10 members and the +/- 1 std filtered mean.
+# The rows are split in blocks of BLOCK_SIZE distributed over the threads
+# with prange. Within a block, each neuron of each member is computed for
+# all the rows of the block in the innermost loop, so that LLVM vectorises
+# it, and only the actual neurons of each member are computed (not the
+# zero padding of the packed tensors).
+#
+# tanh is evaluated as (1 - e) / (1 + e) with e = exp(-2|x|) from a
+# polynomial (see _tanh) rather than by math.tanh, which is not vectorised
+# and would dominate the run time; it agrees with np.tanh to 2.2e-16.
+#
+# predict_numba has the arguments of predict_all and falls back to it when
+# Numba is not installed (HAVE_NUMBA is False). The first call compiles
+# the kernel (cached on disk afterwards). cross_check compares the two
+# engines.
+
+HAVE_NUMBA = njit is not None
+
+# rows per block of the parallel loop
+BLOCK_SIZE = 64
+
+# constants of _tanh: ln(2) split in two parts for an exact range reduction
+LN2_HI = 6.93147180369123816490e-01
+LN2_LO = 1.90821492927058770002e-10
+INV_LN2 = 1.44269504088896338700e+00
+
+if HAVE_NUMBA:
+    @njit(inline='always', fastmath={'contract'})
+    def _tanh(x):
+        # exp(y) = 2**k * exp(r) with |r| <= ln(2) / 2, exp(r) by its Taylor
+        # series to the 13th order; tanh(x) = +/- 1 to double precision
+        # beyond |x| = 20
+        if x != x:
+            return x
+        y = -2 * abs(x)
+        y = -40.0 if y < -40.0 else y
+        k = float(int(0.5 - y * INV_LN2))
+        r = (y + k * LN2_HI) + k * LN2_LO
+        p = 1 / 6227020800
+        p = p * r + 1 / 479001600
+        p = p * r + 1 / 39916800
+        p = p * r + 1 / 3628800
+        p = p * r + 1 / 362880
+        p = p * r + 1 / 40320
+        p = p * r + 1 / 5040
+        p = p * r + 1 / 720
+        p = p * r + 1 / 120
+        p = p * r + 1 / 24
+        p = p * r + 1 / 6
+        p = p * r + 1 / 2
+        p = p * r + 1
+        p = p * r + 1
+        # 2**-k built from its exponent bits
+        e = p * np.int64((1023 - int(k)) << 52).view(np.float64)
+        return math.copysign((1 - e) / (1 + e), x)
+
+    @njit(inline='always', fastmath={'contract'})
+    def _dense(W, j, bias, x, n_in, out, nb):
+        # out[:nb] = bias + sum_k W[k, j] * x[k, :nb], 4 inputs at a time so
+        # that out is loaded and stored once per 4 products
+        for r in range(nb):
+            out[r] = bias
+        k = 0
+        while k + 4 <= n_in:
+            w0, w1, w2, w3 = W[k, j], W[k + 1, j], W[k + 2, j], W[k + 3, j]
+            for r in range(nb):
+                out[r] += w0 * x[k, r] + w1 * x[k + 1, r] + w2 * x[k + 2, r] + w3 * x[k + 3, r]
+            k += 4
+        while k < n_in:
+            w0 = W[k, j]
+            for r in range(nb):
+                out[r] += w0 * x[k, r]
+            k += 1
+
+    @njit(parallel=True, cache=True, error_model='numpy', fastmath={'contract'})
+    def _kernel(dec_year, lat, lon, pres, temp, psal, doxy, moy_in, std_in, IW, b1, LW1, b2, LW2, b3,
+                moy_out, std_out, n1, n2, out):
+        n = lat.shape[0]
+        S, M, n_in, h1 = IW.shape
+        h2 = LW1.shape[3]
+        n_blocks = (n + BLOCK_SIZE - 1) // BLOCK_SIZE
+        for blk in prange(n_blocks):
+            r0 = blk * BLOCK_SIZE
+            nb = min(n, r0 + BLOCK_SIZE) - r0
+            raw = np.empty((n_in, BLOCK_SIZE), dtype=out.dtype)
+            x = np.empty((n_in, BLOCK_SIZE), dtype=out.dtype)
+            a = np.empty((h1, BLOCK_SIZE), dtype=out.dtype)
+            b = np.empty((h2, BLOCK_SIZE), dtype=out.dtype)
+            y = np.empty((S * M, BLOCK_SIZE), dtype=out.dtype)
+
+            # input sequence:
+            #     lat,   lon,    dec_year,    temp,   sal,    oxygen, P
+            for r in range(nb):
+                raw[0, r] = lat[r0 + r]
+                raw[1, r] = lon[r0 + r] - 360 if lon[r0 + r] > 180 else lon[r0 + r]
+                raw[2, r] = dec_year[r0 + r]
+                raw[3, r] = temp[r0 + r]
+                raw[4, r] = psal[r0 + r]
+                raw[5, r] = doxy[r0 + r]
+                t = 1 + math.exp(-pres[r0 + r] / 300)
+                raw[6, r] = pres[r0 + r] / 2e4 + 1 / (t * t * t)
+
+            for s in range(S):
+                for k in range(n_in):
+                    for r in range(nb):
+                        x[k, r] = (2 / 3) * ((raw[k, r] - moy_in[s, 0, 0, k]) / std_in[s, 0, 0, k])
+                for m in range(M):
+                    for j in range(n1[s, m]):
+                        _dense(IW[s, m], j, b1[s, m, 0, j], x, n_in, a[j], nb)
+                        for r in range(nb):
+                            a[j, r] = 1.7159 * _tanh((2 / 3) * a[j, r])
+                    for j in range(n2[s, m]):
+                        _dense(LW1[s, m], j, b2[s, m, 0, j], a, n1[s, m], b[j], nb)
+                        for r in range(nb):
+                            b[j, r] = 1.7159 * _tanh((2 / 3) * b[j, r])
+                    i = s * M + m
+                    _dense(LW2[s, m], 0, b3[s, m, 0, 0], b, n2[s, m], y[i], nb)
+                    for r in range(nb):
+                        y[i, r] = 1.5 * y[i, r] * std_out[s, 0] + moy_out[s, 0]
+
+            # mean of the members within +/- 1 std (ddof = 1), NaN members
+            # excluded, as in ensemble_statistics
+            for r in range(nb):
+                mean = 0.0
+                for k in range(S * M):
+                    mean += y[k, r]
+                mean /= S * M
+                var = 0.0
+                for k in range(S * M):
+                    var += (y[k, r] - mean) ** 2
+                std = math.sqrt(var / (S * M - 1))
+                total = 0.0
+                kept = 0
+                for k in range(S * M):
+                    if not (y[k, r] < mean - std or y[k, r] > mean + std or math.isnan(y[k, r])):
+                        total += y[k, r]
+                        kept += 1
+                out[r0 + r] = total / kept if kept else np.nan
+
+
+def _sizes(model):
+    # (subsets, members) numbers of neurons of the two hidden layers
+    n1 = np.array([[w[0].shape[0] for w in model.members[s]] for s in SUBSETS], dtype=np.int64)
+    n2 = np.array([[w[2].shape[0] for w in model.members[s]] for s in SUBSETS], dtype=np.int64)
+    return n1, n2
+
+
+def _predict_variable(variable, dec_year, inputs, dtype, basedir, out):
+    m = get_model(variable, basedir).astype(dtype)
+    timing = instrument.active()
+    if timing:
+        t = time.perf_counter()
+    _kernel(dec_year, *inputs, m.moy_in, m.std_in, m.IW, m.b1, m.LW1, m.b2, m.LW2, m.b3,
+            m.moy_out, m.std_out, *_sizes(m), out)
+    if timing:
+        # the kernel includes the preprocessing and the aggregation
+        instrument.record('forward', variable, time.perf_counter() - t, out.size)
+    return out
+
+
+def predict_numba(date, lat, lon, pres, temp, psal, doxy, variables=None, basedir=None,
+                  dtype=np.float64, date_type='datetime', convention='fixed', out=None):
+    # predict_all with the fused kernel
+    #
+    # input and output as in predict_all (without full_output)
+    if not HAVE_NUMBA:
+        return predict_all(date, lat, lon, pres, temp, psal, doxy, variables, basedir, dtype,
+                           date_type=date_type, convention=convention, out=out)
+    variables = _variables(variables)
+    timing = instrument.active()
+    if timing:
+        t = time.perf_counter()
+    dec_year = calculate_decimal_year(date, date_type, convention).astype(dtype)
+    if timing:
+        instrument.record('dates', None, time.perf_counter() - t, dec_year.size)
+    n = dec_year.size
+    inputs = [np.ascontiguousarray(np.broadcast_to(np.asarray(x, dtype=dtype).ravel(), (n,)))
+              for x in (lat, lon, pres, temp, psal, doxy)]
+    out = out or {}
+    return {v: _predict_variable(v, dec_year, inputs, dtype, basedir,
+                                 out[v] if v in out else np.empty(n, dtype=dtype))
+            for v in variables}
+
+
+def cross_check(n=10000, seed=0, basedir=None, dtype=np.float64):
+    # Largest deviation of the fused kernel from the NumPy engine, in units
+    # of the output normalisation std of each variable, the fraction of
+    # rows where it exceeds 1e-9 (members at the +/- 1 std limit) and
+    # whether the NaN rows (the first one has no oxygen) match
+    from CANYON_MED_accuracy import synthetic_inputs
+
+    inputs = synthetic_inputs(n, seed)
+    # a missing oxygen, as routine in Argo data
+    inputs[6][0] = np.nan
+    ref = predict_all(*inputs, basedir=basedir, dtype=dtype)
+    res = predict_numba(*inputs, basedir=basedir, dtype=dtype)
+    report = {}
+    for v in VARIABLES:
+        err = np.abs(res[v].astype(np.float64) - ref[v]) / get_model(v, basedir).std_out.max()
+        report[v] = {'max_err': float(np.nanmax(err)), 'flips': float(np.mean(err > 1e-9)),
+                     'nan_match': bool(np.array_equal(np.isnan(res[v]), np.isnan(ref[v])))}
+    return report
+
+
+if __name__ == '__main__':
+    from CANYON_MED_accuracy import synthetic_inputs
+
+    print(f"numba {'available' if HAVE_NUMBA else 'not installed, NumPy fallback'}")
+    for v, r in cross_check().items():
+        print(f"{v:>8} max err {r['max_err']:.2e}  flips {r['flips']:.1e}  NaN match {r['nan_match']}")
+    inputs = synthetic_inputs(10**6)
+    for name, f in (('numpy', predict_all), ('numba', predict_numba)):
+        t = time.perf_counter()
+        f(*inputs)
+        print(f"{name}: {10**6 / (time.perf_counter() - t):.0f} rows/s")
@@ -0,0 +1,122 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from CANYON_MED_models import PACKED, CanyonMedModel, get_model, resolve_basedir, set_basedir
+from CANYON_MED_predict import _chunk_inputs, _variables, predict_all
+
+# Multi-core CANYON-MED predictions
+#
+# The rows are cut into blocks of chunk_size rows that are predicted by a
+# pool of workers and written back in input order. The block boundaries
+# only depend on chunk_size, so the results do not depend on the number
+# of workers or on the order in which they finish.
+#
+# backend:
+#   'thread'  - a thread pool; NumPy releases the GIL in the matrix
+#               products and exp, which dominate the computation
+#   'process' - a process pool; the weights are loaded once in the
+#               calling process and their packed tensors copied into one
+#               shared memory block, which every worker maps at start-up
+#               instead of loading its own copy
+#
+# When using many workers, limit the BLAS threads of each worker (e.g.
+# OMP_NUM_THREADS=1) to avoid oversubscribing the cores.
+
+
+# shared memory block mapped by a process worker, kept open while it lives
+_shared = None
+
+
+def _share_models(models):
+    # Copy the packed tensors of models into a new shared memory block
+    #
+    # output:
+    # (block, layout) where layout[variable][name] = (shape, offset) of
+    # each tensor in the block (offsets aligned on 64 bytes)
+    layout = {}
+    size = 0
+    for v, m in models.items():
+        layout[v] = {}
+        for name in PACKED:
+            x = getattr(m, name)
+            layout[v][name] = (x.shape, size)
+            size += -(-x.nbytes // 64) * 64
+    block = shared_memory.SharedMemory(create=True, size=size)
+    for v, m in models.items():
+        for name, (shape, offset) in layout[v].items():
+            np.ndarray(shape, buffer=block.buf, offset=offset)[...] = getattr(m, name)
+    return block, layout
+
+
+def _worker_init(name, layout, sizes):
+    # process workers: map the shared tensors and serve the models from them
+    global _shared
+    _shared = shared_memory.SharedMemory(name=name)
+    models = {}
+    for v in layout:
+        packed = {k: np.ndarray(shape, buffer=_shared.buf, offset=offset)
+                  for k, (shape, offset) in layout[v].items()}
+        models[v] = CanyonMedModel.from_packed(v, packed, sizes[v])
+    set_basedir(models)
+
+
+def _worker_predict(args):
+    inputs, variables, basedir, kwargs = args
+    return predict_all(*inputs, variables=variables, basedir=basedir, **kwargs)
+
+
+def predict_parallel(date, lat, lon, pres, temp, psal, doxy, n_workers=None,
+                     backend='thread', chunk_size=65536, variables=None, basedir=None,
+                     dtype=np.float64, date_type='datetime', convention='fixed'):
+    # predict_all spread over a pool of workers
+    #
+    # input:
+    # date, lat, lon, pres, temp, psal, doxy, variables, basedir, dtype,
+    # date_type, convention
+    #             - as in predict_all
+    # n_workers   - number of workers, default os.cpu_count()
+    # backend     - 'thread' or 'process'
+    # chunk_size  - number of rows per task
+    #
+    # output:
+    # dict of variable name -> array of predictions, identical to
+    # predict_chunked with the same chunk_size
+    variables = _variables(variables)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    inputs = _chunk_inputs((date, lat, lon, pres, temp, psal, doxy))
+    n = inputs[0].shape[0]
+    starts = range(0, n, chunk_size)
+
+    location = resolve_basedir(basedir)
+    models = {v: get_model(v, location) for v in variables}
+    block = None
+    if backend == 'thread':
+        pool = ThreadPoolExecutor(n_workers)
+        worker_basedir = location
+    elif backend == 'process':
+        block, layout = _share_models(models)
+        sizes = {v: m.sizes() for v, m in models.items()}
+        pool = ProcessPoolExecutor(n_workers, initializer=_worker_init,
+                                   initargs=(block.name, layout, sizes))
+        worker_basedir = None
+    else:
+        raise ValueError(f"unknown backend {backend!r}, expected 'thread' or 'process'")
+
+    out = {v: np.empty(n, dtype=dtype) for v in variables}
+    kwargs = {'dtype': dtype, 'date_type': date_type, 'convention': convention}
+    tasks = (([x[i:i + chunk_size] for x in inputs], variables, worker_basedir, kwargs)
+             for i in starts)
+    try:
+        with pool:
+            for i, res in zip(starts, pool.map(_worker_predict, tasks)):
+                for v in variables:
+                    out[v][i:i + chunk_size] = res[v]
+    finally:
+        if block is not None:
+            block.close()
+            block.unlink()
+    return out
@@ -0,0 +1,454 @@
+import threading
+import time
+
+import numpy as np
+
+import CANYON_MED_instrument as instrument
+from CANYON_MED_models import VARIABLES, get_model, ne
+
+# Shared CANYON-MED prediction engine
+#
+# The inputs are preprocessed once and the resulting feature matrix is
+# fanned out to the networks of all requested variables.
+#
+# All computations are done in float64 by default; dtype=np.float32 runs
+# the preprocessing, the networks and the averaging in single precision
+# (see CANYON_MED_accuracy for the resulting deviation).
+
+# names of the inputs, in the order of the prediction functions
+INPUTS = ('date', 'lat', 'lon', 'pres', 'temp', 'psal', 'doxy')
+
+
+# epochs of the numeric date types, see to_datetime64
+DATE_EPOCHS = {'jd': (np.datetime64('1970-01-01T00:00:00', 'ms'), 2440587.5),
+               'juld': (np.datetime64('1950-01-01T00:00:00', 'ms'), 0.0)}
+
+
+def to_datetime64(date, date_type='datetime'):
+    # Convert dates to a datetime64[ms] array
+    #
+    # date      - dates as described by date_type, scalar or array-like
+    #             (list, numpy array, pandas Series)
+    # date_type - 'datetime': ISO strings ('yyyy-mm-dd', optionally with a
+    #                         time of day 'yyyy-mm-dd HH:MM:SS'), datetime64
+    #                         values or datetime/pandas Timestamp objects
+    #             'jd':       Julian days (2456756.5 for 2014-04-09 00:00)
+    #             'juld':     Argo JULD, days since 1950-01-01 00:00 UTC
+    # All dates are UTC; missing dates (NaN, NaT, 'NaT') give NaT. Numbers
+    # are rejected with date_type='datetime'.
+    # datetime64 values are used as they are whatever the date_type (e.g. an
+    # Argo JULD already decoded by xarray).
+    if date_type != 'datetime' and date_type not in DATE_EPOCHS:
+        raise ValueError(f"unknown date_type {date_type!r}, expected 'datetime', 'jd' or 'juld'")
+    date = np.atleast_1d(np.asarray(date))
+    if date.dtype.kind == 'M':
+        return date.astype('datetime64[ms]')
+    if date_type in DATE_EPOCHS:
+        epoch, offset = DATE_EPOCHS[date_type]
+        ms = np.round((date.astype(np.float64) - offset) * 86400e3)
+        out = np.full(date.shape, np.datetime64('NaT', 'ms'))
+        ok = np.isfinite(ms)
+        out[ok] = epoch + ms[ok].astype(np.int64).astype('timedelta64[ms]')
+        return out
+    if date.dtype.kind in 'fiu':
+        raise ValueError("numeric dates need date_type='jd' (Julian days) or 'juld' (days since "
+                         "1950-01-01), date_type='datetime' expects strings or datetime64 values")
+    if date.dtype.kind == 'O':
+        # datetime and pandas Timestamp objects (tz-naive, UTC)
+        try:
+            return date.astype('datetime64[ms]')
+        except (TypeError, ValueError):
+            return np.array([np.datetime64(x, 'ms') if x == x else np.datetime64('NaT', 'ms')
+                             for x in date.ravel()]).reshape(date.shape)
+    return date.astype('datetime64[ms]')
+
+
+def calculate_decimal_year(date, date_type='datetime', convention='fixed'):
+    # Decimal year of each date
+    #
+    # date, date_type - see to_datetime64
+    # convention - 'fixed': year + elapsed time / 365 days, as in the
+    #                       original Python and R functions (default)
+    #              'leap':  year + elapsed time / length of that year (366
+    #                       days in leap years), as decyear in the MATLAB
+    #                       functions
+    # Missing dates give NaN.
+    date = to_datetime64(date, date_type)
+    year = date.astype('datetime64[Y]')
+    total_seconds = (date - year).astype(np.float64) / 1e3
+    if convention == 'fixed':
+        year_seconds = 365.0 * 24 * 60 * 60
+    elif convention == 'leap':
+        days = (year + 1).astype('datetime64[D]') - year.astype('datetime64[D]')
+        year_seconds = days.astype('timedelta64[s]').astype(np.float64)
+    else:
+        raise ValueError(f"unknown convention {convention!r}, expected 'fixed' or 'leap'")
+    dec_year = (year.astype(np.int64) + 1970) + total_seconds / year_seconds
+    dec_year[np.isnat(date)] = np.nan
+    return dec_year
+
+
+def prepare_inputs(date, lat, lon, pres, temp, psal, doxy, dtype=np.float64,
+                   date_type='datetime', convention='fixed'):
+    # Build the (n, ne) feature matrix shared by all CANYON-MED networks
+    timing = instrument.active()
+    if timing:
+        t = time.perf_counter()
+    dec_year = calculate_decimal_year(date, date_type, convention)
+    if timing:
+        t0, t = t, time.perf_counter()
+        instrument.record('dates', None, t - t0, dec_year.size)
+    X = prepare_features(dec_year, lat, lon, pres, temp, psal, doxy, dtype)
+    if timing:
+        instrument.record('preprocess', None, time.perf_counter() - t, X.shape[0])
+    return X
+
+
+def prepare_features(dec_year, lat, lon, pres, temp, psal, doxy, dtype=np.float64):
+    # Build the (n, ne) feature matrix from decimal years instead of dates
+    #
+    # input sequence:
+    #     lat,   lon,    dec_year,    temp,   sal,    oxygen, P
+    dec_year = np.atleast_1d(dec_year)
+    X = np.empty((dec_year.size, ne), dtype=dtype)
+    X[:, 0] = lat
+    X[:, 1] = lon
+    X[:, 2] = dec_year
+    X[:, 3] = temp
+    X[:, 4] = psal
+    X[:, 5] = doxy
+
+    # convert lon in -180; 180
+    lon = X[:, 1]
+    lon[lon > 180] -= 360
+
+    # convert pres
+    X[:, 6] = pressure_feature(pres, dtype)
+    return X
+
+
+def pressure_feature(pres, dtype=np.float64):
+    # Pressure input of the networks, (pres/2e4) + 1/((1 + exp(-pres/300))**3),
+    # evaluated with one exp per element and in-place operations on two
+    # work arrays. It is not tabulated: an interpolated lookup table over
+    # 0-6000 dbar is slower than the vectorised exp. The result differs
+    # from the direct expression by rounding only: at most 1.2e-15 in
+    # float64 and 3.7e-7 in float32 over 0-6000 dbar.
+    pres = np.atleast_1d(np.asarray(pres, dtype=dtype))
+    t = np.multiply(pres, -1/300)
+    np.exp(t, out=t)
+    t += 1
+    u = t * t
+    u *= t
+    np.divide(1, u, out=u)
+    np.multiply(pres, 1/2e4, out=t)
+    u += t
+    return u
+
+
+# function ### see Eq. XXX in paper XXX
+# 1.7159 * (exp(4/3 x) - 1) / (exp(4/3 x) + 1) = 1.7159 * tanh(2/3 x), computed
+# with one transcendental per element (and without the overflow of exp for
+# large x); in place if out is x
+def custom_MF(x, out=None):
+    out = np.multiply(x, 2/3, out=out)
+    np.tanh(out, out=out)
+    out *= 1.7159
+    return out
+
+
+# per-thread work arrays of the forward pass, see _workspace
+_workspaces = threading.local()
+
+
+def _workspace(model, block_size):
+    # Work arrays for blocks of block_size rows of model, allocated once per
+    # thread and per network shape and reused by all following calls:
+    # (data_N, first layer, second layer, output layer, member outputs)
+    buffers = getattr(_workspaces, 'buffers', None)
+    if buffers is None:
+        buffers = _workspaces.buffers = {}
+    S, M, n_in, h1 = model.IW.shape
+    h2 = model.LW1.shape[-1]
+    key = (S, M, n_in, h1, h2, model.IW.dtype.str, block_size)
+    ws = buffers.get(key)
+    if ws is None:
+        dtype = model.IW.dtype
+        ws = buffers[key] = (np.empty((S, 1, block_size, n_in), dtype=dtype),
+                             np.empty((S, M, block_size, h1), dtype=dtype),
+                             np.empty((S, M, block_size, h2), dtype=dtype),
+                             np.empty((S, M, block_size, 1), dtype=dtype),
+                             np.empty((block_size, S * M), dtype=dtype))
+    return ws
+
+
+def ensemble_outputs(model, X, block_size=256, out=None):
+    # Evaluate all members of a model on the feature matrix X in one
+    # batched matrix product per layer
+    #
+    # The rows are processed in blocks of block_size through per-thread
+    # work arrays (see _workspace), so that the stacked (subsets, members,
+    # rows, neurons) intermediates stay in cache and nothing is allocated
+    # per block.
+    #
+    # out - optional (n, len(SUBSETS) * n_list) array for the result
+    #
+    # output:
+    # (n, len(SUBSETS) * n_list) member outputs, F members first
+    model = model.astype(X.dtype)
+    n = X.shape[0]
+    if out is None:
+        out = np.empty((n, model.IW.shape[0] * model.IW.shape[1]), dtype=X.dtype)
+    ws = _workspace(model, block_size)
+    for i in range(0, n, block_size):
+        _ensemble_block(model, X[i:i + block_size], ws, out[i:i + block_size])
+    return out
+
+
+def _ensemble_block(model, X, ws, out):
+    # NORMALISATION OF THE PARAMETERS, once per subset: (subsets, 1, n, ne)
+    m = X.shape[0]
+    data_N = ws[0][:, :, :m]
+    np.subtract(X, model.moy_in, out=data_N)
+    data_N /= model.std_in
+    data_N *= 2 / 3
+
+    z = ws[1][:, :, :m]
+    np.matmul(data_N, model.IW, out=z)
+    z += model.b1
+    _output_layers(model, z, ws, out)
+
+
+def _output_layers(model, z, ws, out):
+    # From the first layer before activation, (subsets, members, n, h1), to
+    # the (n, subsets * members) member outputs written to out; z is
+    # overwritten
+    m = z.shape[2]
+    a = custom_MF(z, out=z)
+    b = ws[2][:, :, :m]
+    np.matmul(a, model.LW1, out=b)
+    b += model.b2
+    custom_MF(b, out=b)
+    y = ws[3][:, :, :m]
+    np.matmul(b, model.LW2, out=y)
+    y += model.b3
+
+    # (subsets, members, n) -> (n, subsets * members)
+    y = y[..., 0]
+    y *= 1.5
+    y *= model.std_out[:, :, None]
+    y += model.moy_out[:, :, None]
+    out[...] = y.reshape(-1, m).T
+
+
+class CanyonMedResult:
+    # Prediction of one variable with its ensemble statistics, all computed
+    # from the same forward pass
+    #
+    # out     - (n,) mean of the members within +/- 1 std (the estimate
+    #           returned by the CANYON_MED_*_v4 functions)
+    # members - (n, 10) member outputs, F members first
+    # mean_nn - (n,) mean of all members
+    # std_nn  - (n,) standard deviation of the members (ddof = 1), an
+    #           uncertainty estimate of the prediction
+    # n_kept  - (n,) number of members kept by the +/- 1 std rejection
+
+    def __init__(self, out, members, mean_nn, std_nn, n_kept):
+        self.out = out
+        self.members = members
+        self.mean_nn = mean_nn
+        self.std_nn = std_nn
+        self.n_kept = n_kept
+
+    def __len__(self):
+        return len(self.out)
+
+    def __repr__(self):
+        return f"CanyonMedResult(n={len(self.out)}, members={self.members.shape[1]})"
+
+
+def ensemble_statistics(outputs_s, out=None):
+    # Filtered mean of the member outputs and the statistics it is based on
+    #
+    # input:
+    # outputs_s - (n, members) member outputs
+    # out       - optional (n,) array for the filtered mean
+    #
+    # output:
+    # out, mean_nn, std_nn, n_kept as in CanyonMedResult
+    #
+    # The members outside [mean_nn - std_nn, mean_nn + std_nn] and the NaN
+    # members are masked out and the mean of the others is taken as a
+    # masked sum over the kept count (NaN where no member is kept).
+    mean_nn = np.mean(outputs_s, axis=1, keepdims=True)
+    std_nn = np.std(outputs_s, axis=1, ddof = 1, keepdims=True)
+
+    lim_inf = mean_nn - std_nn
+    lim_sup = mean_nn + std_nn
+
+    keep = ~((outputs_s < lim_inf) | (outputs_s > lim_sup) | np.isnan(outputs_s))
+    n_kept = np.count_nonzero(keep, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = np.divide(np.sum(outputs_s, axis=1, where=keep), n_kept, out=out)
+    return out, mean_nn[:, 0], std_nn[:, 0], n_kept
+
+
+def filtered_mean(outputs_s, out=None):
+    # Mean of the member outputs lying within +/- 1 std of the ensemble
+    return ensemble_statistics(outputs_s, out)[0]
+
+
+def predict_variable(variable, X, basedir=None, full_output=False, out=None, block_size=256):
+    # Run the 10-member ensemble of one variable on the feature matrix X
+    # and return the mean of the members within +/- 1 std of the ensemble,
+    # or a CanyonMedResult if full_output
+    #
+    # out - optional (n,) array the filtered mean is written to
+    model = get_model(variable, basedir)
+    n = X.shape[0]
+    timing = instrument.active()
+    if full_output:
+        if timing:
+            t = time.perf_counter()
+        outputs_s = ensemble_outputs(model, X, block_size)
+        if timing:
+            t0, t = t, time.perf_counter()
+            instrument.record('forward', variable, t - t0, n)
+        out, mean_nn, std_nn, n_kept = ensemble_statistics(outputs_s, out)
+        if timing:
+            instrument.record('aggregate', variable, time.perf_counter() - t, n)
+        return CanyonMedResult(out, outputs_s, mean_nn, std_nn, n_kept)
+
+    # the member outputs are only needed block by block
+    model = model.astype(X.dtype)
+    if out is None:
+        out = np.empty(n, dtype=X.dtype)
+    ws = _workspace(model, block_size)
+    forward = aggregate = 0.0
+    for i in range(0, n, block_size):
+        if timing:
+            t0 = time.perf_counter()
+        outputs_s = ws[4][:min(block_size, n - i)]
+        _ensemble_block(model, X[i:i + block_size], ws, outputs_s)
+        if timing:
+            t1 = time.perf_counter()
+        filtered_mean(outputs_s, out[i:i + block_size])
+        if timing:
+            t2 = time.perf_counter()
+            forward += t1 - t0
+            aggregate += t2 - t1
+    if timing:
+        instrument.record('forward', variable, forward, n)
+        instrument.record('aggregate', variable, aggregate, n)
+    return out
+
+
+def predict_all(date, lat, lon, pres, temp, psal, doxy, variables=None, basedir=None,
+                dtype=np.float64, full_output=False, date_type='datetime', convention='fixed',
+                out=None, backend='numpy'):
+    # Multi-layer perceptrons to predict all CANYON-MED variables at once
+    #
+    # input:
+    # date  - date (UTC) as string ('yyyy-mm-dd'), datetime64 or Timestamp,
+    #         or numeric, see date_type
+    # lat   - latitude / °N  [-90 90]
+    # lon   - longitude / °E [-180 180] or [0 360]
+    # pres  - pressure / dbar
+    # temp  - in-situ temperature / °C
+    # psal  - salinity
+    # doxy  - dissolved oxygen / umol kg-1
+    # variables - names of the variables to predict, default all of
+    #             'AT', 'CT', 'NO3', 'PO4', 'SiOH4', 'pHT'
+    # basedir - location of the weights: CANYON-MED folder, bundle file or
+    #           CanyonMedBundle (default: see CANYON_MED_models.resolve_basedir)
+    # dtype - floating point type of the computations, np.float64 or np.float32
+    # full_output - return the member outputs and ensemble statistics too
+    # date_type - 'datetime' (default), 'jd' (Julian days) or 'juld' (Argo
+    #             days since 1950-01-01), see to_datetime64
+    # convention - decimal year convention, 'fixed' (365-day years, default)
+    #             or 'leap' (as MATLAB decyear), see calculate_decimal_year
+    # out - optional dict of variable name -> (n,) array of type dtype the
+    #       predictions are written to (and returned)
+    # backend - 'numpy' (default) or 'numba' for the fused kernel of
+    #       CANYON_MED_numba (NumPy fallback if Numba is not installed;
+    #       full_output is always computed with NumPy)
+    #
+    # output:
+    # dict of variable name -> array of predictions (same units as the
+    # CANYON_MED_*_v4 functions) of type dtype, or -> CanyonMedResult if
+    # full_output
+    #
+    # for example
+    # predict_all(['2014-04-09'], [35], [18], [500], [13.5], [38.6], [160], variables=['NO3', 'PO4'])
+    if backend == 'numba' and not full_output:
+        from CANYON_MED_numba import predict_numba
+        return predict_numba(date, lat, lon, pres, temp, psal, doxy, variables, basedir, dtype,
+                             date_type, convention, out)
+    if backend not in ('numpy', 'numba'):
+        raise ValueError(f"unknown backend {backend!r}, expected 'numpy' or 'numba'")
+    variables = _variables(variables)
+    X = prepare_inputs(date, lat, lon, pres, temp, psal, doxy, dtype, date_type, convention)
+    out = out or {}
+    return {v: predict_variable(v, X, basedir, full_output, out.get(v)) for v in variables}
+
+
+def _variables(variables):
+    if variables is None:
+        return list(VARIABLES)
+    if isinstance(variables, str):
+        return [variables]
+    return list(variables)
+
+
+def _chunk_inputs(chunk):
+    # the 7 input arrays of a chunk given as a sequence in INPUTS order or
+    # as a mapping / DataFrame with INPUTS as keys
+    if isinstance(chunk, (tuple, list)):
+        if len(chunk) != len(INPUTS):
+            raise ValueError(f"expected {len(INPUTS)} input arrays {INPUTS}, got {len(chunk)}")
+        return [np.atleast_1d(np.asarray(x)) for x in chunk]
+    return [np.atleast_1d(np.asarray(chunk[name])) for name in INPUTS]
+
+
+def predict_stream(chunks, chunk_size=65536, variables=None, basedir=None, dtype=np.float64,
+                   full_output=False, date_type='datetime', convention='fixed'):
+    # Predict CANYON-MED variables block by block with bounded memory
+    #
+    # input:
+    # chunks     - iterable of input chunks, each either a sequence
+    #              (date, lat, lon, pres, temp, psal, doxy) of arrays or a
+    #              mapping / DataFrame with these column names
+    # chunk_size - maximum number of rows evaluated at once; larger chunks
+    #              are split, smaller ones are processed as they come
+    # variables, basedir, dtype, full_output, date_type, convention
+    #            - as in predict_all
+    #
+    # output:
+    # generator of dicts of variable name -> array, one per block of at most
+    # chunk_size rows, in input order
+    variables = _variables(variables)
+    for chunk in chunks:
+        inputs = _chunk_inputs(chunk)
+        n = inputs[0].shape[0]
+        for i in range(0, n, chunk_size):
+            yield predict_all(*[x[i:i + chunk_size] for x in inputs],
+                              variables=variables, basedir=basedir, dtype=dtype,
+                              full_output=full_output, date_type=date_type,
+                              convention=convention)
+
+
+def predict_chunked(date, lat, lon, pres, temp, psal, doxy, chunk_size=65536,
+                    variables=None, basedir=None, dtype=np.float64,
+                    date_type='datetime', convention='fixed'):
+    # predict_all over arrays too large to process at once: the rows are
+    # evaluated chunk_size at a time and written into preallocated outputs,
+    # so that the working memory does not grow with the input size
+    variables = _variables(variables)
+    inputs = _chunk_inputs((date, lat, lon, pres, temp, psal, doxy))
+    n = inputs[0].shape[0]
+    out = {v: np.empty(n, dtype=dtype) for v in variables}
+    for i in range(0, n, chunk_size):
+        predict_all(*[x[i:i + chunk_size] for x in inputs], variables=variables, basedir=basedir,
+                    dtype=dtype, date_type=date_type, convention=convention,
+                    out={v: out[v][i:i + chunk_size] for v in variables})
+    return out
@@ -0,0 +1,160 @@
+import threading
+import time
+
+import numpy as np
+
+import CANYON_MED_instrument as instrument
+from CANYON_MED_models import get_model
+from CANYON_MED_predict import (CanyonMedResult, _output_layers, _variables, _workspace,
+                                calculate_decimal_year, ensemble_statistics, filtered_mean,
+                                pressure_feature)
+
+# CANYON-MED predictions on profiles
+#
+# In a profile (float, CTD cast) the date, latitude and longitude are
+# the same at every level. They are the first 3 network inputs, so their
+# contribution to the first layer, IW[:3] . x + b1, is computed once per
+# profile and used as the first layer bias of all its levels, which only
+# carry the 4 varying inputs (temp, psal, doxy, pres). The date is parsed
+# once per profile. The results are those of predict_all up to rounding.
+#
+# for example
+# predict_profile('2014-04-09', 35, 18, [5, 100, 500], [19.1, 16.2, 13.5],
+#                 [38.2, 38.5, 38.6], [220, 200, 160], variables=['NO3'])
+
+# number of network inputs constant along a profile (lat, lon, dec_year)
+N_CONST = 3
+
+# per-thread buffers of the first layer bias gathered for a block of levels
+_biases = threading.local()
+
+
+def _bias_buffer(shape, dtype):
+    buffers = getattr(_biases, 'buffers', None)
+    if buffers is None:
+        buffers = _biases.buffers = {}
+    key = (shape, np.dtype(dtype).str)
+    buf = buffers.get(key)
+    if buf is None:
+        buf = buffers[key] = np.empty(shape, dtype=dtype)
+    return buf
+
+
+def profile_outputs(model, C, V, index=None, block_size=256):
+    # Member outputs of a model on profiles
+    #
+    # input:
+    # C     - (m, N_CONST) constant features of the m profiles
+    # V     - (n, ne - N_CONST) varying features of the levels of all profiles
+    # index - (n,) profile of each level, default all levels in one profile
+    #
+    # output:
+    # (n, len(SUBSETS) * n_list) member outputs, F members first
+    model = model.astype(V.dtype)
+    moy, std = model.moy_in, model.std_in
+    data_C = (2 / 3) * ((C - moy[..., :N_CONST]) / std[..., :N_CONST])
+    # (subsets, members, m, h1) first layer bias of each profile
+    bias = np.matmul(data_C, model.IW[:, :, :N_CONST]) + model.b1
+    IW = model.IW[:, :, N_CONST:]
+
+    n = V.shape[0]
+    out = np.empty((n, model.IW.shape[0] * model.IW.shape[1]), dtype=V.dtype)
+    ws = _workspace(model, block_size)
+    if index is not None:
+        gathered = _bias_buffer(ws[1].shape, V.dtype)
+    for i in range(0, n, block_size):
+        m = min(block_size, n - i)
+        data_N = ws[0][:, :, :m, N_CONST:]
+        np.subtract(V[i:i + m], moy[..., N_CONST:], out=data_N)
+        data_N /= std[..., N_CONST:]
+        data_N *= 2 / 3
+        z = ws[1][:, :, :m]
+        np.matmul(data_N, IW, out=z)
+        if index is None:
+            z += bias
+        else:
+            b1 = gathered[:, :, :m]
+            np.take(bias, index[i:i + m], axis=2, out=b1)
+            z += b1
+        _output_layers(model, z, ws, out[i:i + m])
+    return out
+
+
+def predict_profiles(date, lat, lon, pres, temp, psal, doxy, sizes, variables=None, basedir=None,
+                     dtype=np.float64, full_output=False, date_type='datetime', convention='fixed'):
+    # Predict CANYON-MED variables on many profiles stored as a contiguous
+    # ragged array (the levels of all profiles one after the other)
+    #
+    # input:
+    # date, lat, lon - (m,) date and position of each profile
+    # pres, temp, psal, doxy - (n,) levels of all the profiles, concatenated
+    # sizes - (m,) number of levels of each profile, summing to n
+    # other inputs as in predict_all
+    #
+    # output:
+    # dict of variable name -> (n,) predictions, in the order of the levels
+    # (np.split(out, np.cumsum(sizes)[:-1]) gives one array per profile),
+    # or -> CanyonMedResult if full_output
+    variables = _variables(variables)
+    sizes = np.atleast_1d(np.asarray(sizes, dtype=np.int64))
+    timing = instrument.active()
+    if timing:
+        t = time.perf_counter()
+    dec_year = calculate_decimal_year(date, date_type, convention)
+    if timing:
+        t0, t = t, time.perf_counter()
+        instrument.record('dates', None, t - t0, dec_year.size)
+    C = np.empty((dec_year.size, N_CONST), dtype=dtype)
+    C[:, 0] = lat
+    C[:, 1] = lon
+    C[:, 2] = dec_year
+    # convert lon in -180; 180
+    lon = C[:, 1]
+    lon[lon > 180] -= 360
+
+    pres = np.atleast_1d(pres)
+    if sizes.shape != dec_year.shape or sizes.sum() != pres.size:
+        raise ValueError(f"sizes must give the number of levels of each of the {dec_year.size} profiles, "
+                         f"summing to the {pres.size} levels")
+    V = np.empty((pres.size, 4), dtype=dtype)
+    V[:, 0] = temp
+    V[:, 1] = psal
+    V[:, 2] = doxy
+    V[:, 3] = pressure_feature(pres, dtype)
+    index = None if sizes.size == 1 else np.repeat(np.arange(sizes.size), sizes)
+    if timing:
+        instrument.record('preprocess', None, time.perf_counter() - t, V.shape[0])
+
+    results = {}
+    for v in variables:
+        model = get_model(v, basedir)
+        if timing:
+            t = time.perf_counter()
+        outputs_s = profile_outputs(model, C, V, index)
+        if timing:
+            t0, t = t, time.perf_counter()
+            instrument.record('forward', v, t - t0, V.shape[0])
+        if full_output:
+            out, mean_nn, std_nn, n_kept = ensemble_statistics(outputs_s)
+            results[v] = CanyonMedResult(out, outputs_s, mean_nn, std_nn, n_kept)
+        else:
+            results[v] = filtered_mean(outputs_s)
+        if timing:
+            instrument.record('aggregate', v, time.perf_counter() - t, V.shape[0])
+    return results
+
+
+def predict_profile(date, lat, lon, pres, temp, psal, doxy, variables=None, basedir=None,
+                    dtype=np.float64, full_output=False, date_type='datetime', convention='fixed'):
+    # Predict CANYON-MED variables on one profile
+    #
+    # input:
+    # date, lat, lon - date and position of the profile (scalars)
+    # pres, temp, psal, doxy - arrays of the levels
+    # other inputs as in predict_all
+    #
+    # output:
+    # dict of variable name -> predictions at each level
+    pres = np.atleast_1d(pres)
+    return predict_profiles(date, lat, lon, pres, temp, psal, doxy, [pres.size], variables, basedir,
+                            dtype, full_output, date_type, convention)
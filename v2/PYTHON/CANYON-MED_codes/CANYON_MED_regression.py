@@ -0,0 +1,249 @@
+import argparse
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+
+from CANYON_MED_accuracy import synthetic_inputs
+from CANYON_MED_models import VARIABLES, get_model, resolve_basedir
+from CANYON_MED_predict import predict_all, predict_chunked
+
+# Golden-value regression harness
+#
+# A fixed corpus of inputs spanning the Mediterranean domain, the depth
+# range and the seasons is run through a reference implementation, which
+# is the original pandas / per-member / per-row CANYON_MED_*_v4 code
+# kept verbatim below. The member outputs (F then G) and the +/- 1 std
+# filtered mean of every variable are recorded, and the optimised engines
+# are checked against them within the tolerances of TOLERANCES.
+#
+# usage:
+#   python CANYON_MED_regression.py record golden.npz [--rows 20000]
+#   python CANYON_MED_regression.py check [golden.npz] [--engines float64 float32 ...]
+# check exits with a non-zero status if any engine is out of tolerance.
+
+# tolerances, in units of the output normalisation std of each variable:
+#   members - maximum deviation of any member output, for the engines
+#             that return the members (full_output of predict_all)
+#   mean    - deviation of the filtered mean, allowed on all rows but a
+#             fraction max_flips of them, where a member at the +/- 1 std
+#             limit may be kept by one computation and not the other (the
+#             mean then still has to stay within one ensemble std)
+TOLERANCES = {
+    'float64': {'members': 1e-9, 'mean': 1e-9, 'max_flips': 1e-4},
+    'chunked': {'mean': 1e-9, 'max_flips': 1e-4},
+    'parallel': {'mean': 1e-9, 'max_flips': 1e-4},
+    'float32': {'members': 2e-4, 'mean': 2e-4, 'max_flips': 1e-2},
+    'numba': {'mean': 1e-9, 'max_flips': 1e-4},
+}
+
+
+def golden_corpus(n=20000, seed=42):
+    # the fixed corpus of inputs, with dates as 'yyyy-mm-dd' strings as
+    # expected by the original functions
+    date, lat, lon, pres, temp, psal, doxy = synthetic_inputs(n, seed)
+    date = date.astype('datetime64[D]').astype(str)
+    # half of the longitudes in [0 360]
+    lon = np.where(np.arange(n) % 2 == 0, np.mod(lon, 360), lon)
+    return date, lat, lon, pres, temp, psal, doxy
+
+
+def reference_v4(variable, date, lat, lon, pres, temp, psal, doxy, basedir):
+    # The original CANYON_MED_*_v4 computation (13.06.2023), returning the
+    # (n, 10) member outputs and the filtered mean
+    import pandas as pd
+
+    prefix = VARIABLES[variable]
+    basedir = os.path.join(basedir, "")
+
+    df = pd.DataFrame({'lat' : np.array(lat, dtype=float), 'lon' : np.array(lon, dtype=float), 'date' : np.array(date),
+                      'temp' : np.array(temp, dtype=float), 'psal' : np.array(psal, dtype=float), 'doxy' : np.array(doxy, dtype=float),
+                      'pres' : np.array(pres, dtype=float)})
+
+    def calculate_decimal_year(date):
+        date = datetime.strptime(date, '%Y-%m-%d')
+        year = date.year
+        base_date = datetime(year, 1, 1)
+        total_seconds = (date - base_date).total_seconds()
+        decimal_year = year + total_seconds / (365.0 * 24 * 60 * 60)
+        return decimal_year
+
+    df['date'] = df['date'].apply(lambda x : calculate_decimal_year(x))
+    df['lon'] = df['lon'].apply(lambda x : x - 360 if x>180 else x)
+    df['pres'] = df['pres'].apply(lambda x : (x/2e4) + (1/((1 + np.exp(-x/300))**3)))
+
+    ne = 7
+    n_list = 5
+
+    def custom_MF(x):
+        tmp = 1.7159 * ((np.exp((4/3)*x) - 1)/(np.exp((4/3)*x) + 1))
+        return(tmp)
+
+    outputs = []
+    for s in ('F', 'G'):
+        moy = np.array(pd.read_table(basedir + f"CANYON-MED_weights/moy_{prefix}_{s}.txt", sep=" {3}", header=None, engine = 'python'))
+        std = np.array(pd.read_table(basedir + f"CANYON-MED_weights/std_{prefix}_{s}.txt", sep=" {3}", header=None, engine = 'python'))
+
+        data_N = df.iloc[:, :ne].copy()
+        for i in range(ne):
+            data_N.iloc[:, i] = (2 / 3) * ((df.iloc[:, i] - moy[:, i]) / std[:, i])
+        data_N = np.array(data_N)
+
+        for i in range(1,n_list+1):
+            b1 = np.array(pd.read_csv(basedir + f"CANYON-MED_weights/poids_{prefix}_b1_{s}_{i}.txt", header=None))
+            b2 = np.array(pd.read_csv(basedir + f"CANYON-MED_weights/poids_{prefix}_b2_{s}_{i}.txt", header=None))
+            b3 = np.array(pd.read_csv(basedir + f"CANYON-MED_weights/poids_{prefix}_b3_{s}_{i}.txt", header=None))
+            IW = pd.read_csv(basedir + f"CANYON-MED_weights/poids_{prefix}_IW_{s}_{i}.txt", sep=r"\s+", header=None)
+            LW1 = pd.read_csv(basedir + f"CANYON-MED_weights/poids_{prefix}_LW1_{s}_{i}.txt", sep=r"\s+", header=None)
+            LW2 = pd.read_csv(basedir + f"CANYON-MED_weights/poids_{prefix}_LW2_{s}_{i}.txt", sep=r"\s+", header=None)
+
+            a = custom_MF(np.dot(data_N, IW.T).T + b1)
+            b = custom_MF(np.dot(LW1, a) + b2)
+            y = (np.dot(LW2, b) + b3).T
+            outputs.append(1.5 * y * std[0][ne] + moy[0][ne])
+
+    outputs_s = np.squeeze(np.array(outputs).T, axis = 0)
+
+    mean_nn = np.mean(outputs_s, axis=1)
+    std_nn = np.std(outputs_s, axis=1, ddof = 1)
+
+    lim_inf = mean_nn - std_nn
+    lim_sup = mean_nn + std_nn
+
+    out_t = outputs_s.copy()
+    for i in range(outputs_s.shape[0]):
+        out_t[i,:] = np.where(out_t[i,:]<lim_inf[i], np.nan, out_t[i,:])
+        out_t[i,:] = np.where(out_t[i,:]>lim_sup[i], np.nan, out_t[i,:])
+
+    return np.array(outputs_s), np.nanmean(out_t, axis=1)
+
+
+def record(path=None, n=20000, seed=42, basedir=None):
+    # Compute the reference outputs on the golden corpus; save them to
+    # path (.npz) if given
+    #
+    # output:
+    # dict with the corpus inputs ('date', 'lat', ...) and, per variable,
+    # '<var>/members' (n, 10) and '<var>/mean' (n,)
+    basedir = resolve_basedir(basedir)
+    if not isinstance(basedir, (str, os.PathLike)) or os.fspath(basedir).endswith('.npz'):
+        raise ValueError("the reference is computed from the text weights, basedir must be a CANYON-MED folder")
+    inputs = golden_corpus(n, seed)
+    golden = dict(zip(('date', 'lat', 'lon', 'pres', 'temp', 'psal', 'doxy'), inputs))
+    for v in VARIABLES:
+        golden[f"{v}/members"], golden[f"{v}/mean"] = reference_v4(v, *inputs, basedir)
+    if path is not None:
+        np.savez_compressed(path, **golden)
+    return golden
+
+
+def _engine(name, inputs, basedir):
+    # member outputs and filtered means of one engine
+    #
+    # output:
+    # (members, means), members being None for the engines that only
+    # return the filtered means, or None if the engine is not available
+    dtype = np.float32 if name == 'float32' else np.float64
+    members = None
+    if name in ('float64', 'float32'):
+        res = predict_all(*inputs, basedir=basedir, dtype=dtype, full_output=True)
+        members = {v: res[v].members for v in VARIABLES}
+        means = predict_all(*inputs, basedir=basedir, dtype=dtype)
+    elif name == 'chunked':
+        means = predict_chunked(*inputs, chunk_size=997, basedir=basedir)
+    elif name == 'numba':
+        from CANYON_MED_numba import HAVE_NUMBA
+        if not HAVE_NUMBA:
+            # predict_all would silently check the NumPy fallback
+            return None
+        means = predict_all(*inputs, basedir=basedir, backend='numba')
+    elif name == 'parallel':
+        from CANYON_MED_parallel import predict_parallel
+        means = predict_parallel(*inputs, n_workers=4, chunk_size=997, basedir=basedir)
+    else:
+        raise ValueError(f"unknown engine {name!r}, expected one of {list(TOLERANCES)}")
+    return members, means
+
+
+def check(golden, engines=None, basedir=None):
+    # Compare engines against the golden outputs
+    #
+    # input:
+    # golden  - output of record(), or path of a recorded .npz file
+    # engines - names of the engines to check, default all of TOLERANCES
+    #
+    # output:
+    # list of (engine, variable, members max err, mean max err,
+    #          fraction of rows beyond the mean tolerance, passed)
+    # with errors in units of the output normalisation std; the members
+    # error is None for the engines that do not return the members, and
+    # all entries are None if the engine is not available (numba not
+    # installed)
+    if isinstance(golden, (str, os.PathLike)):
+        with np.load(golden) as f:
+            golden = {k: f[k] for k in f.files}
+    if engines is None:
+        engines = list(TOLERANCES)
+    inputs = tuple(golden[k] for k in ('date', 'lat', 'lon', 'pres', 'temp', 'psal', 'doxy'))
+
+    results = []
+    for name in engines:
+        tol = TOLERANCES[name]
+        res = _engine(name, inputs, basedir)
+        if res is None:
+            results.extend((name, v, None, None, None, None) for v in VARIABLES)
+            continue
+        members, means = res
+        for v in VARIABLES:
+            ref_members, ref_mean = golden[f"{v}/members"], golden[f"{v}/mean"]
+            scale = get_model(v, basedir).std_out.max()
+            spread = np.std(ref_members, axis=1, ddof=1)
+
+            err_members = None
+            if members is not None:
+                err_members = float(np.max(np.abs(members[v] - ref_members)) / scale)
+            err_mean = np.abs(means[v].astype(np.float64) - ref_mean)
+            flips = np.mean(err_mean / scale > tol['mean'])
+            passed = bool((err_members is None or err_members <= tol['members'])
+                          and flips <= tol['max_flips'] and np.all(err_mean <= spread))
+            results.append((name, v, err_members, float(np.max(err_mean) / scale),
+                            float(flips), passed))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CANYON-MED golden-value regression harness")
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('record', help="compute and save the reference outputs")
+    p.add_argument('path')
+    p.add_argument('--rows', type=int, default=20000)
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--basedir')
+    p = sub.add_parser('check', help="check the engines against the reference outputs")
+    p.add_argument('path', nargs='?', help="recorded reference (default: compute it now)")
+    p.add_argument('--engines', nargs='+', choices=list(TOLERANCES))
+    p.add_argument('--rows', type=int, default=20000)
+    p.add_argument('--basedir')
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        record(args.path, args.rows, args.seed, args.basedir)
+        print(args.path)
+        return 0
+
+    golden = args.path if args.path else record(n=args.rows, basedir=args.basedir)
+    failures = 0
+    print(f"{'engine':>9} {'variable':>8} {'members':>10} {'mean':>10} {'flips':>8}")
+    for name, v, err_members, err_mean, flips, passed in check(golden, args.engines, args.basedir):
+        if passed is None:
+            print(f"{name:>9} {v:>8} {'':>10} {'':>10} {'':>8}  skipped ({name} not installed)")
+            continue
+        failures += not passed
+        members = 'n/a' if err_members is None else f"{err_members:.2e}"
+        print(f"{name:>9} {v:>8} {members:>10} {err_mean:10.2e} {flips:8.2e}  {'ok' if passed else 'FAILED'}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
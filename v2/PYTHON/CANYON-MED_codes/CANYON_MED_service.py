@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from CANYON_MED_instrument import StageSummary, add_hook, remove_hook
+from CANYON_MED_models import get_model
+from CANYON_MED_predict import INPUTS, _variables, predict_all, to_datetime64
+
+# CANYON-MED prediction service
+#
+# A small asyncio HTTP server (on a TCP port or a Unix socket) keeping the
+# models in memory. Concurrent requests are coalesced into micro-batches:
+# the first request of a batch waits at most max_delay for others to
+# arrive (or until max_batch rows are queued), the batch goes through the
+# networks in one call, run in a worker thread so that the server keeps
+# accepting requests, and each request receives its own rows.
+#
+# POST /predict with a JSON body
+#   {"date": ["2014-04-09"], "lat": [35], "lon": [18], "pres": [500],
+#    "temp": [13.5], "psal": [38.6], "doxy": [160],
+#    "variables": ["NO3", "PO4"], "date_type": "datetime"}
+# ("variables" and "date_type" are optional) returns
+#   {"NO3": [5.9115...], "PO4": [0.3029...]}
+# with null for missing values. GET /stats returns the batching counters
+# and GET /metrics the batching and stage counters (see
+# CANYON_MED_instrument) in the Prometheus text format.
+#
+# usage:
+#   python CANYON_MED_service.py [--port 8080] [--unix /tmp/canyon-med.sock]
+#       [--max-delay-ms 5] [--max-batch 65536] [--basedir /path/to/PYTHON/]
+
+
+class MicroBatcher:
+    # Coalesce concurrent predictions into batches
+    #
+    # input:
+    # variables - variables served, default all (loaded at start)
+    # max_delay - maximum time, in s, the first request of a batch waits
+    #             for others
+    # max_batch - number of rows above which a batch is run at once
+    # basedir, dtype, convention - as in predict_all
+    #
+    # for example, within a coroutine
+    # batcher = MicroBatcher(variables=['NO3'])
+    # res = await batcher.predict(['2014-04-09'], [35], [18], [500], [13.5], [38.6], [160])
+
+    def __init__(self, variables=None, max_delay=0.005, max_batch=65536, basedir=None,
+                 dtype=np.float64, convention='fixed'):
+        self.variables = _variables(variables)
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.basedir = basedir
+        self.dtype = dtype
+        self.convention = convention
+        self.requests = 0
+        self.rows = 0
+        self.batches = 0
+        self.busy = 0.0
+        self._queue = None
+        self._task = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        for v in self.variables:
+            get_model(v, basedir)
+
+    def stats(self):
+        return {'requests': self.requests, 'rows': self.rows, 'batches': self.batches,
+                'rows_per_batch': self.rows / self.batches if self.batches else 0.0,
+                'busy_s': self.busy}
+
+    async def predict(self, date, lat, lon, pres, temp, psal, doxy, variables=None,
+                      date_type='datetime'):
+        # predictions of one request, as a dict of variable name -> array
+        variables = self.variables if variables is None else _variables(variables)
+        unknown = set(variables) - set(self.variables)
+        if unknown:
+            raise ValueError(f"variables {sorted(unknown)} are not served, expected {self.variables}")
+        inputs = [to_datetime64(date, date_type)]
+        inputs += [np.atleast_1d(np.asarray(x, dtype=np.float64)) for x in (lat, lon, pres, temp, psal, doxy)]
+        n = inputs[0].size
+        if any(x.shape != (n,) for x in inputs):
+            raise ValueError(f"the inputs {INPUTS} must be 1-D arrays of the same length")
+
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((inputs, variables, future))
+        return await future
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._executor.shutdown(wait=False)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            rows = batch[0][0][0].size
+            deadline = loop.time() + self.max_delay
+            while rows < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+                rows += batch[-1][0][0].size
+
+            variables = [v for v in self.variables if any(v in item[1] for item in batch)]
+            inputs = [np.concatenate([item[0][k] for item in batch]) for k in range(len(INPUTS))]
+            start = time.perf_counter()
+            try:
+                res = await loop.run_in_executor(self._executor, self._predict, inputs, variables)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.busy += time.perf_counter() - start
+            self.requests += len(batch)
+            self.rows += rows
+            self.batches += 1
+
+            i = 0
+            for item_inputs, item_variables, future in batch:
+                n = item_inputs[0].size
+                if not future.done():
+                    future.set_result({v: res[v][i:i + n] for v in item_variables})
+                i += n
+
+    def _predict(self, inputs, variables):
+        return predict_all(*inputs, variables=variables, basedir=self.basedir, dtype=self.dtype,
+                           convention=self.convention)
+
+
+def _response(writer, status, body):
+    if isinstance(body, str):
+        data, content_type = body.encode(), 'text/plain; version=0.0.4'
+    else:
+        data, content_type = json.dumps(body).encode(), 'application/json'
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+    writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                 f"Content-Length: {len(data)}\r\n\r\n".encode() + data)
+
+
+def _metrics(batcher, summary):
+    lines = []
+    for name, value in batcher.stats().items():
+        if name != 'rows_per_batch':
+            name = 'busy_seconds' if name == 'busy_s' else name
+            lines.append(f"# TYPE canyon_med_service_{name}_total counter")
+            lines.append(f"canyon_med_service_{name}_total {value}")
+    return '\n'.join(lines) + '\n' + summary.to_prometheus()
+
+
+async def _handle(batcher, summary, reader, writer):
+    # HTTP/1.1 connection, kept alive until the client closes it
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            method, path, _ = line.decode('latin-1').split(' ', 2)
+            length = 0
+            keep_alive = True
+            while True:
+                header = (await reader.readline()).decode('latin-1').strip()
+                if not header:
+                    break
+                name, _, value = header.partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+                elif name.lower() == 'connection' and value.strip().lower() == 'close':
+                    keep_alive = False
+            body = await reader.readexactly(length) if length else b''
+
+            if method == 'GET' and path == '/stats':
+                _response(writer, 200, batcher.stats())
+            elif method == 'GET' and path == '/metrics':
+                _response(writer, 200, _metrics(batcher, summary))
+            elif method == 'POST' and path == '/predict':
+                try:
+                    request = json.loads(body)
+                    res = await batcher.predict(*[request[name] for name in INPUTS],
+                                                variables=request.get('variables'),
+                                                date_type=request.get('date_type', 'datetime'))
+                except (KeyError, TypeError, ValueError) as e:
+                    _response(writer, 400, {'error': f"{type(e).__name__}: {e}"})
+                except Exception as e:
+                    _response(writer, 500, {'error': f"{type(e).__name__}: {e}"})
+                else:
+                    _response(writer, 200, {v: [x if x == x else None for x in out.tolist()]
+                                            for v, out in res.items()})
+            else:
+                _response(writer, 404, {'error': f"no route {method} {path}"})
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host='127.0.0.1', port=8080, unix=None, **kwargs):
+    # Run the service until cancelled; kwargs are passed to MicroBatcher
+    summary = add_hook(StageSummary())
+    batcher = MicroBatcher(**kwargs)
+    handler = lambda reader, writer: _handle(batcher, summary, reader, writer)
+    if unix is not None:
+        server = await asyncio.start_unix_server(handler, unix)
+    else:
+        server = await asyncio.start_server(handler, host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.close()
+        remove_hook(summary)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CANYON-MED prediction service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix', help="listen on a Unix socket instead of a TCP port")
+    parser.add_argument('--variables', nargs='+')
+    parser.add_argument('--max-delay-ms', type=float, default=5.0,
+                        help="latency budget for batching requests (default 5 ms)")
+    parser.add_argument('--max-batch', type=int, default=65536)
+    parser.add_argument('--basedir')
+    args = parser.parse_args(argv)
+
+    where = args.unix or f"http://{args.host}:{args.port}"
+    print(f"CANYON-MED service on {where}", file=sys.stderr)
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix, variables=args.variables,
+                          max_delay=args.max_delay_ms / 1e3, max_batch=args.max_batch,
+                          basedir=args.basedir))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+import numpy as np
+
+from CANYON_MED_predict import _variables, calculate_decimal_year, predict_variable, prepare_features
+
+# Input validation and Mediterranean domain mask
+#
+# The CANYON_MED_*_v4 functions do not check their inputs. validate flags
+# each row with a status code:
+#   STATUS_MISSING - a missing input (NaN, NaT, None)
+#   STATUS_RANGE   - an input outside RANGES (e.g. fill values as 99999)
+#   STATUS_DOMAIN  - a position outside the Mediterranean Sea
+# combined as bits (0 for a valid row). predict_validated runs the
+# networks on the valid rows only and returns NaN for the others, with the
+# status of every row.
+#
+# The domain is a coarse outline of the Mediterranean Sea (west of the
+# Strait of Gibraltar, without the Sea of Marmara and the Black Sea) with
+# its largest islands removed, rasterised once on a regular grid, in the
+# spirit of the 1° grid CY_doy_pres_limit.csv of the first version; a
+# position is then checked by one lookup. The outline is accurate to about
+# 10-20 km and the grid is dilated by one cell so that coastal
+# observations are kept: the mask catches positions in the Atlantic, on
+# land or with swapped coordinates, it does not resolve the coastline.
+#
+# for example
+# out, status = predict_validated(date, lat, lon, pres, temp, psal, doxy, variables=['NO3'])
+
+STATUS_OK = 0
+STATUS_MISSING = 1
+STATUS_RANGE = 2
+STATUS_DOMAIN = 4
+STATUS_NAMES = {STATUS_MISSING: 'missing', STATUS_RANGE: 'range', STATUS_DOMAIN: 'domain'}
+
+# valid range of each input (lon in -180; 180), bounds included
+RANGES = {
+    'dec_year': (1950, 2100),
+    'lat': (30, 46),
+    'lon': (-6, 37),
+    'pres': (0, 6000),
+    'temp': (5, 35),
+    'psal': (30, 41),
+    'doxy': (0, 450),
+}
+
+# outline of the Mediterranean Sea, (lon, lat) counter-clockwise from the
+# Strait of Gibraltar along the European coast
+MED_OUTLINE = [
+    (-5.6, 36.0), (-4.4, 36.7), (-2.1, 36.7), (-0.7, 37.6), (-0.4, 39.4), (0.2, 38.8),
+    (0.9, 40.7), (2.2, 41.4), (3.2, 42.0), (3.05, 42.7), (3.1, 43.1), (3.5, 43.3), (4.0, 43.5),
+    (4.8, 43.4), (6.0, 43.1), (7.3, 43.7), (8.9, 44.4), (10.2, 43.9), (10.5, 42.9),
+    (12.3, 41.7), (14.3, 40.8), (15.7, 40.0), (16.1, 38.7), (15.6, 38.0), (16.1, 38.0),
+    (17.1, 39.0), (16.5, 40.1), (17.2, 40.5), (18.4, 40.0), (18.5, 40.2), (17.0, 41.1),
+    (15.9, 41.6), (14.3, 42.4), (13.5, 43.6), (12.6, 44.0), (12.3, 44.4), (12.5, 44.95),
+    (12.3, 45.3), (13.7, 45.7), (13.6, 45.1), (14.5, 45.3), (15.2, 44.2), (16.4, 43.5),
+    (18.1, 42.6), (19.0, 42.1), (19.4, 41.3), (19.4, 40.4), (20.0, 39.7), (20.7, 38.8),
+    (21.1, 38.3), (21.3, 37.6), (21.7, 36.8), (22.4, 36.4), (23.2, 36.4), (23.0, 37.6),
+    (24.0, 37.7), (23.5, 38.5), (22.8, 39.3), (22.6, 40.5), (23.8, 40.2), (24.4, 40.9),
+    (26.0, 40.8), (26.7, 40.65), (26.2, 40.1), (26.2, 39.5), (26.8, 38.9), (26.4, 38.3),
+    (27.2, 37.7), (27.4, 37.0), (28.2, 36.7), (29.1, 36.6), (30.5, 36.3), (30.7, 36.9),
+    (32.0, 36.5), (34.0, 36.3), (34.7, 36.8), (36.0, 36.9), (35.9, 35.9), (35.8, 35.2),
+    (35.9, 34.5), (35.5, 33.9), (35.1, 33.1), (34.7, 32.1), (34.2, 31.3), (33.0, 31.1),
+    (32.3, 31.3), (31.0, 31.6), (29.9, 31.2), (28.0, 31.1), (25.2, 31.6), (23.9, 32.1),
+    (22.6, 32.8), (21.7, 32.9), (20.1, 32.1), (20.0, 31.0), (19.0, 30.3), (17.5, 31.0),
+    (15.6, 31.5), (15.2, 32.4), (13.2, 32.9), (11.2, 33.2), (10.9, 33.8), (10.1, 34.3),
+    (11.1, 35.2), (10.6, 35.8), (10.5, 36.7), (11.1, 37.1), (10.2, 37.2), (9.8, 37.3),
+    (8.6, 36.9), (7.8, 36.9), (6.3, 37.1), (5.1, 36.7), (3.0, 36.8), (1.0, 36.5), (-0.6, 35.8),
+    (-2.2, 35.1), (-3.9, 35.2), (-5.3, 35.9), (-5.6, 35.8),
+]
+
+# largest islands, removed from the domain
+MED_ISLANDS = [
+    # Mallorca
+    [(2.3, 39.5), (2.6, 39.95), (3.2, 39.95), (3.5, 39.7), (3.1, 39.3)],
+    # Corsica
+    [(8.6, 41.4), (8.6, 42.4), (9.4, 43.0), (9.6, 42.2), (9.2, 41.4)],
+    # Sardinia
+    [(8.4, 39.0), (8.4, 40.0), (8.2, 40.9), (9.2, 41.3), (9.8, 40.9), (9.6, 39.2), (9.0, 39.0)],
+    # Sicily
+    [(12.4, 37.8), (13.3, 38.2), (15.6, 38.3), (15.1, 37.3), (15.1, 36.7), (14.3, 37.0), (12.6, 37.6)],
+    # Crete
+    [(23.5, 35.3), (23.6, 35.6), (25.0, 35.4), (26.3, 35.3), (26.1, 35.0), (24.7, 34.9)],
+    # Cyprus
+    [(32.3, 34.7), (32.3, 35.1), (33.0, 35.4), (34.6, 35.7), (33.9, 35.1), (33.6, 34.8), (33.0, 34.6)],
+]
+
+_masks = {}
+
+
+def _inside(polygon, x, y):
+    # even-odd rule: points (x, y) inside the polygon [(x, y), ...]
+    p = np.array(polygon)
+    inside = np.zeros(np.shape(x), dtype=bool)
+    for (x1, y1), (x2, y2) in zip(p, np.roll(p, -1, axis=0)):
+        if y1 == y2:
+            continue
+        crosses = (y1 > y) != (y2 > y)
+        inside ^= crosses & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+    return inside
+
+
+def domain_mask(resolution=0.1):
+    # Rasterised Mediterranean domain, computed on first use
+    #
+    # output:
+    # (mask, lon0, lat0, resolution) where mask[i, j] is True for the cell
+    # [lat0 + i * resolution, lat0 + (i + 1) * resolution[ x
+    # [lon0 + j * resolution, lon0 + (j + 1) * resolution[
+    if resolution not in _masks:
+        outline = np.array(MED_OUTLINE)
+        lon0, lat0 = np.floor(outline.min(axis=0)) - resolution
+        lon1, lat1 = np.ceil(outline.max(axis=0)) + resolution
+        lon = lon0 + (np.arange(int(round((lon1 - lon0) / resolution))) + 0.5) * resolution
+        lat = lat0 + (np.arange(int(round((lat1 - lat0) / resolution))) + 0.5) * resolution
+        x, y = np.meshgrid(lon, lat)
+        sea = _inside(MED_OUTLINE, x, y)
+        for island in MED_ISLANDS:
+            sea &= ~_inside(island, x, y)
+        # dilation by one cell
+        mask = sea.copy()
+        mask[1:] |= sea[:-1]
+        mask[:-1] |= sea[1:]
+        mask[:, 1:] |= sea[:, :-1]
+        mask[:, :-1] |= sea[:, 1:]
+        _masks[resolution] = (mask, lon0, lat0, resolution)
+    return _masks[resolution]
+
+
+def in_domain(lat, lon, resolution=0.1):
+    # True for the positions within the Mediterranean domain (lon in
+    # [-180 180] or [0 360]; NaN positions are outside)
+    mask, lon0, lat0, res = domain_mask(resolution)
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    lon = np.where(lon > 180, lon - 360, lon)
+    with np.errstate(invalid='ignore'):
+        i = np.floor((lat - lat0) / res)
+        j = np.floor((lon - lon0) / res)
+        ok = (i >= 0) & (i < mask.shape[0]) & (j >= 0) & (j < mask.shape[1])
+    result = np.zeros(np.broadcast_shapes(lat.shape, lon.shape), dtype=bool)
+    result[ok] = mask[i[ok].astype(np.intp), j[ok].astype(np.intp)]
+    return result
+
+
+def validate(dec_year, lat, lon, pres, temp, psal, doxy, ranges=None, domain=True):
+    # Status code of each row (see STATUS_*)
+    #
+    # input:
+    # dec_year - decimal years (see calculate_decimal_year)
+    # lat ... doxy - as in predict_all
+    # ranges - dict of input name -> (min, max) replacing those of RANGES
+    #          (None to disable the check of an input)
+    # domain - check the Mediterranean domain mask
+    #
+    # output:
+    # (n,) uint8 array of the combined STATUS_* bits, 0 for valid rows
+    dec_year = np.atleast_1d(dec_year)
+    n = dec_year.size
+    limits = dict(RANGES)
+    limits.update(ranges or {})
+    values = {'dec_year': dec_year, 'lat': lat, 'lon': lon, 'pres': pres, 'temp': temp,
+              'psal': psal, 'doxy': doxy}
+    values = {k: np.broadcast_to(np.asarray(x, dtype=np.float64).ravel(), (n,)) for k, x in values.items()}
+    values['lon'] = np.where(values['lon'] > 180, values['lon'] - 360, values['lon'])
+
+    status = np.zeros(n, dtype=np.uint8)
+    for name, x in values.items():
+        status[~np.isfinite(x)] |= STATUS_MISSING
+        if limits.get(name) is not None:
+            lo, hi = limits[name]
+            with np.errstate(invalid='ignore'):
+                status[(x < lo) | (x > hi)] |= STATUS_RANGE
+    if domain:
+        status[~in_domain(values['lat'], values['lon']) & ((status & STATUS_MISSING) == 0)] |= STATUS_DOMAIN
+    return status
+
+
+def status_names(status):
+    # names of the bits of a status code, e.g. ['range', 'domain'] for 6
+    return [name for bit, name in STATUS_NAMES.items() if status & bit]
+
+
+def predict_validated(date, lat, lon, pres, temp, psal, doxy, variables=None, basedir=None,
+                      dtype=np.float64, ranges=None, domain=True, date_type='datetime',
+                      convention='fixed'):
+    # predict_all on the valid rows only
+    #
+    # input:
+    # ranges, domain - see validate
+    # other inputs as in predict_all
+    #
+    # output:
+    # out    - dict of variable name -> (n,) predictions, NaN for the
+    #          invalid rows
+    # status - (n,) status code of each row
+    variables = _variables(variables)
+    dec_year = calculate_decimal_year(date, date_type, convention)
+    n = dec_year.size
+    inputs = [np.broadcast_to(np.asarray(x).ravel(), (n,)) for x in (lat, lon, pres, temp, psal, doxy)]
+    status = validate(dec_year, *inputs, ranges=ranges, domain=domain)
+
+    valid = np.flatnonzero(status == STATUS_OK)
+    X = prepare_features(dec_year[valid], *[x[valid] for x in inputs], dtype=dtype)
+    out = {}
+    for v in variables:
+        out[v] = np.full(n, np.nan, dtype=dtype)
+        out[v][valid] = predict_variable(v, X, basedir)
+    return out, status
@@ -0,0 +1,144 @@
+import numpy as np
+
+from CANYON_MED_models import ne
+from CANYON_MED_predict import (INPUTS, _variables, calculate_decimal_year, predict_variable,
+                                pressure_feature)
+
+# CANYON-MED predictions on gridded fields (xarray)
+#
+# The inputs are DataArrays (or scalars) whose dimensions are broadcast
+# against each other by name, e.g. a 4-D temperature field
+# (time, depth, lat, lon) with the 1-D coordinates time, lat and lon and a
+# (depth,) or (depth, lat) pressure. The features are computed on each
+# input in its own shape (the decimal year once per time step, the
+# pressure transform once per level) and broadcast directly into the
+# feature matrix, without flattening copies of the inputs. The outputs are
+# DataArrays with the broadcast dimensions and coordinates of the inputs,
+# in the dimension order of the temperature field followed by the
+# dimensions it lacks.
+#
+# Dask-backed inputs (or chunks=...) are processed lazily, block by block;
+# the outputs are then dask arrays computed on .compute() / .to_netcdf().
+#
+# The networks expect pressure (dbar) and in-situ temperature: model
+# output on depth levels or with potential temperature must be converted
+# first.
+#
+# for example
+# ds = xr.open_dataset('climatology.nc', chunks={'time': 1})
+# out = predict_dataset(ds, variables=['NO3', 'PO4'],
+#                       names={'date': 'time', 'temp': 'temperature', 'doxy': 'oxygen'})
+# out.to_netcdf('climatology_canyon_med.nc')
+
+# attributes of the output DataArrays
+ATTRS = {
+    'AT': {'long_name': 'total alkalinity', 'units': 'umol kg-1'},
+    'CT': {'long_name': 'total dissolved inorganic carbon', 'units': 'umol kg-1'},
+    'NO3': {'long_name': 'nitrate', 'units': 'umol kg-1'},
+    'PO4': {'long_name': 'phosphate', 'units': 'umol kg-1'},
+    'SiOH4': {'long_name': 'silicate', 'units': 'umol kg-1'},
+    'pHT': {'long_name': 'pH (total scale at insitu PTS)', 'units': '1'},
+}
+
+# names looked up in a Dataset for each input, in order, by predict_dataset
+NAMES = {
+    'date': ('date', 'time', 'TIME', 'JULD'),
+    'lat': ('lat', 'latitude', 'LATITUDE'),
+    'lon': ('lon', 'longitude', 'LONGITUDE'),
+    'pres': ('pres', 'PRES', 'pressure'),
+    'temp': ('temp', 'TEMP', 'temperature'),
+    'psal': ('psal', 'PSAL', 'salinity'),
+    'doxy': ('doxy', 'DOXY', 'oxygen'),
+}
+
+
+def _xarray():
+    try:
+        import xarray
+    except ImportError:
+        raise ImportError("xarray is required for the gridded CANYON-MED predictions") from None
+    return xarray
+
+
+def predict_grid(date, lat, lon, pres, temp, psal, doxy, variables, basedir=None, dtype=np.float64,
+                 date_type='datetime', convention='fixed'):
+    # Predictions for NumPy inputs of broadcastable shapes
+    #
+    # output:
+    # tuple of arrays of the broadcast shape, one per variable (a single
+    # array for a single variable, as expected by xr.apply_ufunc)
+    inputs = (date, lat, lon, pres, temp, psal, doxy)
+    shape = np.broadcast_shapes(*(np.shape(x) for x in inputs))
+    X = np.empty(shape + (ne,), dtype=dtype)
+    X[..., 0] = lat
+    X[..., 1] = lon
+    X[..., 2] = calculate_decimal_year(date, date_type, convention).reshape(np.shape(date))
+    X[..., 3] = temp
+    X[..., 4] = psal
+    X[..., 5] = doxy
+    lon = X[..., 1]
+    lon[lon > 180] -= 360
+    X[..., 6] = pressure_feature(pres, dtype).reshape(np.shape(pres))
+
+    X = X.reshape(-1, ne)
+    res = tuple(predict_variable(v, X, basedir).reshape(shape) for v in variables)
+    return res[0] if len(res) == 1 else res
+
+
+def predict_xarray(date, lat, lon, pres, temp, psal, doxy, variables=None, basedir=None,
+                   dtype=np.float64, date_type='datetime', convention='fixed', chunks=None):
+    # Predictions for DataArray inputs, broadcast by dimension name
+    #
+    # input:
+    # date ... doxy - DataArrays or scalars, in the units of CANYON_MED_*_v4
+    # variables     - variables to predict, default all six
+    # chunks        - optional dask chunks applied to the inputs (e.g.
+    #                 {'time': 1}) to compute lazily, block by block
+    # other inputs as in predict_all
+    #
+    # output:
+    # dict of variable name -> DataArray
+    xr = _xarray()
+    variables = _variables(variables)
+    args = [x if isinstance(x, xr.DataArray) else xr.DataArray(x) for x in (date, lat, lon, pres, temp, psal, doxy)]
+    if chunks is not None:
+        args = [x.chunk({d: c for d, c in chunks.items() if d in x.dims}) for x in args]
+
+    out = xr.apply_ufunc(predict_grid, *args,
+                         kwargs={'variables': variables, 'basedir': basedir, 'dtype': dtype,
+                                 'date_type': date_type, 'convention': convention},
+                         output_core_dims=[[] for _ in variables],
+                         dask='parallelized', output_dtypes=[dtype for _ in variables])
+    if len(variables) == 1:
+        out = (out,)
+    results = {}
+    for v, da in zip(variables, out):
+        da = da.transpose(*args[4].dims, ...)
+        da.name = v
+        da.attrs = dict(ATTRS[v])
+        results[v] = da
+    return results
+
+
+def predict_dataset(ds, variables=None, names=None, basedir=None, dtype=np.float64,
+                    date_type='datetime', convention='fixed', chunks=None):
+    # Add the predictions to a Dataset
+    #
+    # input:
+    # ds    - Dataset holding the inputs as variables or coordinates
+    # names - dict of input name (date, lat, ...) -> name in ds, for the
+    #         inputs not found under one of the names of NAMES
+    # other inputs as in predict_xarray
+    #
+    # output:
+    # copy of ds with one DataArray per predicted variable
+    names = dict(names or {})
+    for name in INPUTS:
+        if name not in names:
+            found = [k for k in NAMES[name] if k in ds.variables]
+            if not found:
+                raise KeyError(f"no {name} input in the dataset, expected one of {NAMES[name]} or names={{'{name}': ...}}")
+            names[name] = found[0]
+    results = predict_xarray(*[ds[names[name]] for name in INPUTS], variables=variables, basedir=basedir,
+                             dtype=dtype, date_type=date_type, convention=convention, chunks=chunks)
+    return ds.assign(results)